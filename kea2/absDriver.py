@@ -51,6 +51,18 @@ class AbstractDriver(abc.ABC):
     def getStaticChecker(self, hierarchy) -> AbstractStaticChecker:
         pass
 
+    @classmethod
+    def setStaticCheckerOptions(cls, **kwargs):
+        """Configure the static checker. (optional for drivers)"""
+        pass
+
+    @classmethod
+    def detachStaticChecker(cls) -> bool:
+        """Make the static checker work without the device, in the precondition workers.
+        (optional for drivers) Returns whether it's supported.
+        """
+        return False
+
     @classmethod
     @abc.abstractmethod
     def tearDown(self): ...
@@ -1,10 +1,15 @@
+import hashlib
+import shlex
+from abc import ABC, abstractmethod
 import sys
 import subprocess
 import threading
-from typing import List, Optional, Set, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
 
 from kea2.utils import getLogger
-from adbutils import AdbDevice, adb
+from adbutils import AdbConnection, AdbDevice, adb
 from typing import IO, TYPE_CHECKING, Generator, Optional, List, Union
 
 logger = getLogger(__name__)
@@ -57,6 +62,77 @@ class ADBDevice(AdbDevice):
             pid = pids[0].split()[1]
             self.shell(f"kill {pid}")
 
+    def exec_out(self, cmd: str, stream: bool = False) -> Union[bytes, AdbConnection]:
+        """
+        Run the command with the exec service (adb exec-out). The output is raw bytes (no pty).
+
+        Returns:
+            bytes: the output, or the connection to read the output from if stream
+        """
+        c = self.open_transport()
+        c.send_command("exec:" + cmd)
+        c.check_okay()
+        if stream:
+            return c
+        try:
+            return c.read_until_close(encoding=None)
+        finally:
+            c.close()
+
+    def md5sum(self, remote_paths: List[str]) -> Dict[str, str]:
+        """
+        Get the md5 of the files on device in one shell call. The missing files are not included.
+        """
+        if not remote_paths:
+            return dict()
+        r = self.shell(f"md5sum {' '.join(shlex.quote(p) for p in remote_paths)} 2>/dev/null")
+        res = dict()
+        for line in r.splitlines():
+            fields = line.split(maxsplit=1)
+            if len(fields) == 2 and len(fields[0]) == 32:
+                res[fields[1].strip()] = fields[0]
+        return res
+
+    def push_files(self, files: List[Tuple[Path, str]], max_workers: int = 4) -> List[str]:
+        """
+        Push the files (local path, remote path) to the device concurrently.
+        The files identical (md5) to the ones on device are skipped.
+
+        Returns:
+            List[str]: the remote paths pushed
+        """
+        remote_md5 = self.md5sum([remote for _, remote in files])
+        to_push = [
+            (local, remote) for local, remote in files
+            if remote_md5.get(remote) != _md5sum(local)
+        ]
+        logger.info(f"Pushing {len(to_push)} files. {len(files) - len(to_push)} files unchanged on device.")
+        if to_push:
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(to_push))) as executor:
+                for future in [executor.submit(self.sync.push, local, remote) for local, remote in to_push]:
+                    future.result()
+        return [remote for _, remote in to_push]
+
+
+def _md5sum(path: Path) -> str:
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class StreamSink(ABC):
+    """
+    A sink receiving the output of a StreamShell (see StreamShell.add_sink).
+    """
+    @abstractmethod
+    def write(self, text: str):
+        ...
+
+    def close(self):
+        pass
+
 
 class StreamShell:
     def __init__(self, session: "ADBDevice"):
@@ -66,20 +142,41 @@ class StreamShell:
         self.stdout = sys.stdout
         self.stderr = sys.stderr
         self._finished = False
+        self.sinks: List[StreamSink] = []
 
     def __call__(self, cmdargs: Union[List[str], str], stdout: IO = None, 
                  stderr: IO = None, timeout: Union[float, None] = None) -> "StreamShell":
         pass
 
+    def add_sink(self, sink: "StreamSink") -> "StreamShell":
+        """ Add a sink receiving the output. Should be added before running the command.
+        The output is not printed to sys.stdout by default if any sink is added.
+        """
+        self.sinks.append(sink)
+        return self
+
     def _write_stdout(self, data: bytes, decode=True):
         text = data.decode('utf-8', errors='ignore') if decode else data
-        self.stdout.write(text)
-        self.stdout.flush()
+        if self.stdout:
+            self.stdout.write(text)
+            self.stdout.flush()
+        for sink in self.sinks:
+            sink.write(text)
 
     def _write_stderr(self, data: bytes, decode=True):
         text = data.decode('utf-8', errors='ignore') if decode else data
-        self.stderr.write(text)
-        self.stderr.flush()
+        if self.stderr:
+            self.stderr.write(text)
+            self.stderr.flush()
+        for sink in self.sinks:
+            sink.write(text)
+
+    def _close_sinks(self):
+        for sink in self.sinks:
+            try:
+                sink.close()
+            except Exception as e:
+                print(f"Error when closing the output sink: {e}")
     
     def wait(self):
         """ Wait for the shell command to finish and return the exit code.
@@ -126,8 +223,9 @@ class ADBStreamShell_V1(StreamShell):
         timeout: Union[float, None] = None
     ):
         self._finished = False
-        self.stdout: IO = stdout if stdout else sys.stdout
-        self.stderr: IO = stdout if stderr else sys.stdout
+        default_out = None if self.sinks else sys.stdout
+        self.stdout: IO = stdout if stdout else default_out
+        self.stderr: IO = stdout if stderr else default_out
 
         cmd = " ".join(cmdargs) if isinstance(cmdargs, list) else cmdargs
         self._generator = self._shell_v1(cmd, timeout)
@@ -169,6 +267,8 @@ class ADBStreamShell_V1(StreamShell):
         except Exception as e:
             print(f"ADBStreamShell execution error: {e}")
             self._exit_code = -1
+        finally:
+            self._close_sinks()
 
 
 class ADBStreamShell_V2(StreamShell):
@@ -176,6 +276,7 @@ class ADBStreamShell_V2(StreamShell):
         self.dev: ADBDevice = session
         self._thread = None
         self._exit_code = 255
+        self.sinks: List[StreamSink] = []
 
     def __call__(
         self, cmdargs: Union[List[str], str], stdout: IO = None, 
@@ -198,8 +299,8 @@ class ADBStreamShell_V2(StreamShell):
             ADBStreamShell: An instance of ADBStreamShell that can be used to interact with the shell command.
         """
         self._finished = False
-        self.stdout: IO = stdout if stdout else sys.stdout
-        self.stderr: IO = stderr if stderr else sys.stderr
+        self.stdout: IO = stdout if stdout else (None if self.sinks else sys.stdout)
+        self.stderr: IO = stderr if stderr else (None if self.sinks else sys.stderr)
 
         cmd = " ".join(cmdargs) if isinstance(cmdargs, list) else cmdargs
         self._generator = self._shell_v2(cmd, timeout)
@@ -222,6 +323,8 @@ class ADBStreamShell_V2(StreamShell):
         except Exception as e:
             print(f"ADBStreamShell execution error: {e}")
             self._exit_code = -1
+        finally:
+            self._close_sinks()
 
     def _shell_v2(self, cmd, timeout) -> Generator[Tuple[str, bytes], None, None]:
         with self.dev.open_transport(timeout=timeout) as c:
@@ -9,6 +9,7 @@ from concurrent.futures import ThreadPoolExecutor
 
 from PIL import Image, ImageDraw, ImageFont
 from jinja2 import Environment, FileSystemLoader, select_autoescape, PackageLoader
+from kea2.resultStore import readResult
 from kea2.utils import getLogger, catchException
 
 logger = getLogger(__name__)
@@ -174,8 +175,8 @@ class BugReportGenerator:
 
         if not self.data_path.result_json.exists():
             logger.error(f"{self.data_path.result_json} not found")
-        with open(self.data_path.result_json, "r", encoding="utf-8") as f:
-            self._test_result: TestResult = json.load(f)
+        # replay the result journal (if the run did not exit normally)
+        self._test_result: TestResult = readResult(self.data_path.result_json)
 
         return self._test_result
 
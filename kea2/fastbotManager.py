@@ -1,22 +1,184 @@
 from retry import retry
 from retry.api import retry_call
 from dataclasses import asdict
+import bisect
+import json
+import socket
+import time
+from collections import defaultdict
+from http.client import HTTPException
 import requests
 from packaging.version import parse as parse_version
 
-from uiautomator2.core import HTTPResponse, _http_request
-from kea2.adbUtils import ADBDevice, ADBStreamShell_V2
+from uiautomator2.core import AdbHTTPConnection, HTTPResponse, _http_request
+from uiautomator2.exceptions import HTTPError, HTTPTimeoutError
+from kea2.adbUtils import ADBDevice, ADBStreamShell_V2, StreamSink
+from kea2.logSink import RotatingFileSink
+from kea2.tracer import span
 from pathlib import Path
 from kea2.utils import getLogger, getProjectRoot
 
 
-from typing import IO, TYPE_CHECKING, Dict
+from typing import IO, TYPE_CHECKING, Any, Dict, List, Optional, Set, Tuple
 if TYPE_CHECKING:
     from .keaUtils import Options, PropertyExecutionInfo
 
 
 logger = getLogger(__name__)
 
+FASTBOT_ABIS = ["arm64-v8a", "armeabi-v7a", "x86", "x86_64"]
+
+
+class BlockPayloadEncoder:
+    """
+    Encode the block widgets of /stepMonkey as a delta.
+    The block lists are only sent (with a new "block_version") when they change.
+    Otherwise, only the version last received by the server is sent.
+    Only used when the server confirms "blockDelta" at /init (see FastbotManager.init).
+    """
+    BLOCK_KEYS = ("block_widgets", "block_trees")
+
+    def __init__(self):
+        self.version = 0
+        # (version, widgets, trees) received by the server
+        self._acked: Optional[Tuple[int, Set[str], Set[str]]] = None
+        self._pending: Optional[Tuple[int, Set[str], Set[str]]] = None
+
+    def encode(self, monkeyStepInfo: Dict) -> Dict:
+        widgets = set(monkeyStepInfo.get("block_widgets", []))
+        trees = set(monkeyStepInfo.get("block_trees", []))
+        payload = {k: v for k, v in monkeyStepInfo.items() if k not in self.BLOCK_KEYS}
+        if self._acked is not None and self._acked[1:] == (widgets, trees):
+            payload["block_version"] = self._acked[0]
+        else:
+            self.version += 1
+            payload["block_version"] = self.version
+            payload["block_widgets"] = list(widgets)
+            payload["block_trees"] = list(trees)
+        self._pending = (payload["block_version"], widgets, trees)
+        return payload
+
+    def ack(self):
+        """
+        The last encoded payload was received by the server.
+        A payload never acked (e.g., the request failed) is resent in full.
+        """
+        self._acked = self._pending
+
+
+class LatencyHistogram:
+    """
+    Histogram of the request latencies (ms) in log-scale buckets.
+    """
+    BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, float("inf"))
+
+    def __init__(self):
+        self.counts = [0] * len(self.BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, cost_ms: float):
+        self.counts[bisect.bisect_left(self.BUCKETS, cost_ms)] += 1
+        self.count += 1
+        self.total += cost_ms
+        self.max = max(self.max, cost_ms)
+
+    def percentile(self, p: float) -> float:
+        """
+        The upper bound of the bucket containing the p-th percentile.
+        """
+        target = self.count * p / 100
+        accumulated = 0
+        for bound, count in zip(self.BUCKETS, self.counts):
+            accumulated += count
+            if accumulated >= target and accumulated > 0:
+                return min(bound, self.max)
+        return 0.0
+
+    def __str__(self):
+        if self.count == 0:
+            return "no request"
+        return (
+            f"count: {self.count}, avg: {self.total / self.count:.1f}ms, "
+            f"p50: <={self.percentile(50):.0f}ms, p90: <={self.percentile(90):.0f}ms, max: {self.max:.1f}ms"
+        )
+
+
+class FastbotSession:
+    """
+    Keep-alive HTTP session to the fastbot server.
+    One forwarded connection is reused for all the requests. It is reopened after a failure.
+    """
+    HEADERS = {
+        "User-Agent": "kea2",
+        # nanohttpd gzip has resource leaks
+        "Accept-Encoding": "",
+        "Content-Type": "application/json",
+    }
+
+    def __init__(self, dev, port: int = 8090):
+        self.dev = dev
+        self.port = port
+        self.connect_count = 0
+        self.latency: Dict[str, LatencyHistogram] = defaultdict(LatencyHistogram)
+        self._conn: Optional[AdbHTTPConnection] = None
+
+    def request(self, method: str, path: str, data: Dict[str, Any] = None, timeout: float = 10) -> HTTPResponse:
+        start = time.perf_counter()
+        reused = self._conn is not None and self._conn.sock is not None
+        try:
+            try:
+                res = self._request(method, path, data, timeout)
+            except ConnectionError:
+                if not reused:
+                    raise
+                # the server closed the idle connection. Retry once with a new one.
+                self.close()
+                res = self._request(method, path, data, timeout)
+        except socket.timeout as e:
+            self.close()
+            raise HTTPTimeoutError(f"HTTP request timeout: {e}") from e
+        except (OSError, HTTPException) as e:
+            self.close()
+            raise HTTPError(f"HTTP request failed: {e}") from e
+        except HTTPError:
+            self.close()
+            raise
+        self.latency[path].record((time.perf_counter() - start) * 1000)
+        return res
+
+    def _request(self, method: str, path: str, data: Optional[Dict[str, Any]], timeout: float) -> HTTPResponse:
+        logger.debug(f"http request {method} {path} {data}")
+        if self._conn is None:
+            self._conn = AdbHTTPConnection(self.dev, port=self.port)
+        conn = self._conn
+        conn.timeout = timeout
+        if conn.sock is None:
+            self.connect_count += 1
+        else:
+            conn.sock.settimeout(timeout)
+        if data:
+            conn.request(method, path, json.dumps(data), headers=self.HEADERS)
+        else:
+            conn.request(method, path, headers=self.HEADERS)
+        _response = conn.getresponse()
+        # read the whole body to reuse the connection
+        content = _response.read()
+        if _response.status != 200:
+            raise HTTPError(f"HTTP request failed: {_response.status} {_response.reason}")
+        return HTTPResponse(content)
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def logStatistics(self):
+        logger.info(f"[Fastbot Session] connections: {self.connect_count}")
+        for path, histogram in self.latency.items():
+            logger.info(f"[Fastbot Session] {path} {histogram}")
+
 
 class FastbotManager:
     def __init__(self, options: "Options", log_file: str):
@@ -25,8 +187,14 @@ class FastbotManager:
         self.port = None
         self.thread = None
         self._device_output_dir = None
+        # created when the server confirms the block delta protocol at /init
+        self._blockEncoder: Optional[BlockPayloadEncoder] = None
+        # whether the server confirms the batch protocol at /init (see stepMonkeyBatch)
+        self.batch_supported = False
+        self._logSinks: List[StreamSink] = []
         ADBDevice.setDevice(options.serial, options.transport_id)
         self.dev = ADBDevice()
+        self.session = FastbotSession(self.dev, port=8090)
         self.android_release = parse_version(self.dev.getprop("ro.build.version.release"))
 
     def _activateFastbot(self) -> ADBStreamShell_V2:
@@ -37,38 +205,21 @@ class FastbotManager:
         :return: the fastbot daemon thread
         """
         cur_dir = Path(__file__).parent
-        self.dev.sync.push(
-            Path.joinpath(cur_dir, "assets/monkeyq.jar"),
-            "/sdcard/monkeyq.jar"
-        )
-        self.dev.sync.push(
-            Path.joinpath(cur_dir, "assets/fastbot-thirdpart.jar"),
-            "/sdcard/fastbot-thirdpart.jar",
-        )
-        self.dev.sync.push(
-            Path.joinpath(cur_dir, "assets/kea2-thirdpart.jar"),
-            "/sdcard/kea2-thirdpart.jar",
-        )
-        self.dev.sync.push(
-            Path.joinpath(cur_dir, "assets/framework.jar"),
-            "/sdcard/framework.jar",
-        )
-        self.dev.sync.push(
-            Path.joinpath(cur_dir, "assets/fastbot_libs/arm64-v8a/libfastbot_native.so"),
-            "/data/local/tmp/arm64-v8a/libfastbot_native.so",
-        )
-        self.dev.sync.push(
-            Path.joinpath(cur_dir, "assets/fastbot_libs/armeabi-v7a/libfastbot_native.so"),
-            "/data/local/tmp/armeabi-v7a/libfastbot_native.so",
-        )
-        self.dev.sync.push(
-            Path.joinpath(cur_dir, "assets/fastbot_libs/x86/libfastbot_native.so"),
-            "/data/local/tmp/x86/libfastbot_native.so",
-        )
-        self.dev.sync.push(
-            Path.joinpath(cur_dir, "assets/fastbot_libs/x86_64/libfastbot_native.so"),
-            "/data/local/tmp/x86_64/libfastbot_native.so",
-        )
+        files = [
+            (Path.joinpath(cur_dir, "assets/monkeyq.jar"), "/sdcard/monkeyq.jar"),
+            (Path.joinpath(cur_dir, "assets/fastbot-thirdpart.jar"), "/sdcard/fastbot-thirdpart.jar"),
+            (Path.joinpath(cur_dir, "assets/kea2-thirdpart.jar"), "/sdcard/kea2-thirdpart.jar"),
+            (Path.joinpath(cur_dir, "assets/framework.jar"), "/sdcard/framework.jar"),
+        ]
+
+        # only push the native lib of the device's abi (all the libs if unknown)
+        abi = (self.dev.getprop("ro.product.cpu.abi") or "").strip()
+        abis = [abi] if abi in FASTBOT_ABIS else FASTBOT_ABIS
+        for abi in abis:
+            files.append((
+                Path.joinpath(cur_dir, f"assets/fastbot_libs/{abi}/libfastbot_native.so"),
+                f"/data/local/tmp/{abi}/libfastbot_native.so",
+            ))
 
         cwd = getProjectRoot()
         whitelist = self.options.act_whitelist_file
@@ -81,12 +232,13 @@ class FastbotManager:
                 file_to_push = cwd / 'configs' / 'abl.strings'
                 remote_path = blacklist
 
-            self.dev.sync.push(
-                file_to_push,
-                remote_path
-            )
+            files.append((file_to_push, remote_path))
 
-        t = self._startFastbotService()
+        with span("push assets", "startup", files=len(files)):
+            self.dev.push_files(files)
+
+        with span("start fastbot", "startup"):
+            t = self._startFastbotService()
         logger.info("Running Fastbot...")
 
         return t
@@ -105,7 +257,7 @@ class FastbotManager:
             raise RuntimeError("Failed to connect fastbot")
 
     def request(self, method: str, path: str, data: Dict=None, timeout: int=10) -> HTTPResponse:
-        return _http_request(self.dev, 8090, method, path, data, timeout)
+        return self.session.request(method, path, data, timeout)
 
     @retry(Exception, tries=2, delay=2)
     def init(self, options: "Options", stamp):
@@ -114,9 +266,11 @@ class FastbotManager:
             "Stamp": stamp,
             "deviceOutputRoot": options.device_output_root,
         }
-        r = _http_request(
-            self.dev,
-            device_port=8090,
+        if options.block_delta:
+            post_data["blockDelta"] = True
+        if options.batch_steps > 1:
+            post_data["batchSteps"] = True
+        r = self.request(
             method="POST",
             path="/init",
             data=post_data
@@ -125,15 +279,52 @@ class FastbotManager:
         import re
         self._device_output_dir = re.match(r"outputDir:(.+)", r.text).group(1)
         print(f"[INFO] Fastbot initiated. outputDir: {r.text}", flush=True)
+        # the server confirms the optional protocols with "<name>:true" lines
+        confirmed = set(re.findall(r"^(\w+):true$", r.text, re.MULTILINE))
+        if options.block_delta:
+            # a server without the protocol ignores blockDelta, and block_version would unblock everything
+            if "blockDelta" in confirmed:
+                self._blockEncoder = BlockPayloadEncoder()
+            else:
+                self._blockEncoder = None
+                logger.warning("Fastbot does not support --block-delta. Send the full block lists at every step.")
+        if options.batch_steps > 1:
+            self.batch_supported = "batchSteps" in confirmed
+            if not self.batch_supported:
+                logger.warning("Fastbot does not support --batch-steps. Send the monkey events one by one.")
     
     @retry(Exception, tries=2, delay=2)
-    def stepMonkey(self, monkeyStepInfo):
-        r = self.request(
-            method="POST",
-            path="/stepMonkey",
-            data=monkeyStepInfo
+    def stepMonkey(self, monkeyStepInfo) -> str:
+        return self._postStep(monkeyStepInfo)["result"]
+
+    @retry(Exception, tries=2, delay=2)
+    def stepMonkeyBatch(
+        self, monkeyStepInfo, batch_size: int, fingerprints: bool = False
+    ) -> Tuple[List[str], str]:
+        """
+        send batch_size monkey events in one request. Only if the server confirms it at /init (batch_supported).
+        :params: fingerprints: only get the fingerprints of the intermediate hierarchies
+        :return: the hierarchies (or fingerprints) of the intermediate events, and the hierarchy of the last event
+        """
+        res = self._postStep(
+            {**monkeyStepInfo, "batch_size": batch_size, "batch_fingerprints": fingerprints}
         )
-        return r.json()["result"]
+        intermediates = res.get("fingerprints" if fingerprints else "hierarchies", [])
+        return intermediates, res["result"]
+
+    def _postStep(self, monkeyStepInfo) -> Dict:
+        if self._blockEncoder is not None:
+            monkeyStepInfo = self._blockEncoder.encode(monkeyStepInfo)
+        with span("/stepMonkey", "fastbot"):
+            r = self.request(
+                method="POST",
+                path="/stepMonkey",
+                data=monkeyStepInfo
+            )
+            res = r.json()
+        if self._blockEncoder is not None:
+            self._blockEncoder.ack()
+        return res
 
     @retry(Exception, tries=2, delay=2)
     def stopMonkey(self):
@@ -149,15 +340,16 @@ class FastbotManager:
     
     @retry(Exception, tries=2, delay=2)
     def logScript(self, execution_info: "PropertyExecutionInfo"):
-        r = self.request(
-            method="POST",
-            path="/logScript",
-            data={
-                "propName": execution_info.propName,
-                "startStepsCount": execution_info.startStepsCount,
-                "state": execution_info.state,
-            }
-        )
+        with span("/logScript", "fastbot"):
+            r = self.request(
+                method="POST",
+                path="/logScript",
+                data={
+                    "propName": execution_info.propName,
+                    "startStepsCount": execution_info.startStepsCount,
+                    "state": execution_info.state,
+                }
+            )
         res = r.text
         if res != "OK":
             print(f"[ERROR] Error when logging script: {execution_info}", flush=True)
@@ -204,14 +396,27 @@ class FastbotManager:
         full_cmd = ["adb"] + (["-s", self.options.serial] if self.options.serial else []) + ["shell"] + shell_command
 
 
-        outfile = open(self.log_file, "w", encoding="utf-8", buffering=1)
-
         logger.info("Options info: {}".format(asdict(self.options)))
         logger.info("Launching fastbot with shell command:\n{}".format(" ".join(full_cmd)))
-        logger.info("Fastbot log will be saved to {}".format(outfile.name))
+        log_sink = RotatingFileSink(
+            self.log_file,
+            buffer_size=self.options.log_buffer_size,
+            max_bytes=self.options.log_max_size * 1024 * 1024,
+            backup_count=self.options.log_backups,
+            compress=self.options.log_compress,
+        )
+        logger.info("Fastbot log will be saved to {}".format(log_sink.path))
 
-        t = self.dev.stream_shell(shell_command, stdout=outfile, stderr=outfile)
-        return t
+        t = self.dev.stream_shell.add_sink(log_sink)
+        for sink in self._logSinks:
+            t.add_sink(sink)
+        return t(shell_command)
+
+    def add_log_sink(self, sink: StreamSink):
+        """
+        Receive the fastbot output with the sink (besides the log file). Should be added before start.
+        """
+        self._logSinks.append(sink)
 
     def close_on_exit(self, proc: ADBStreamShell_V2, f: IO):
         self.return_code = proc.wait()
@@ -232,6 +437,8 @@ class FastbotManager:
 
     def join(self):
         self.thread.join()
+        self.session.close()
+        self.session.logStatistics()
 
 
 
@@ -1,10 +1,12 @@
-from collections import deque
+import atexit
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 import json
 import os
 from pathlib import Path
 import traceback
 import time
-from typing import Callable, Any, Deque, Dict, List, Literal, NewType, Union
+from typing import Callable, Any, Deque, Dict, List, Literal, NewType, Optional, Set, Union
 from unittest import TextTestRunner, registerResult, TestSuite, TestCase, TextTestResult
 import random
 import warnings
@@ -12,9 +14,13 @@ from dataclasses import dataclass, asdict
 from kea2.absDriver import AbstractDriver
 from functools import wraps
 from kea2.bug_report_generator import BugReportGenerator
+from kea2.resultStore import ResultStore
 from kea2.resultSyncer import ResultSyncer
+from kea2.scheduler import SCHEDULERS, PropertyScheduler, makeScheduler
+from kea2.tracer import span, startTracing, stopTracing
 from kea2.logWatcher import LogWatcher
-from kea2.utils import TimeStamp, catchException, getProjectRoot, getLogger, timer
+from kea2.precondPool import PrecondPool
+from kea2.utils import TimeStamp, catchException, getHierarchyFingerprint, getProjectRoot, getLogger, timer
 from kea2.u2Driver import StaticU2UiObject, StaticXpathUiObject
 from kea2.fastbotManager import FastbotManager
 from kea2.adbUtils import ADBDevice
@@ -24,6 +30,8 @@ import types
 PRECONDITIONS_MARKER = "preconds"
 PROP_MARKER = "prop"
 MAX_TRIES_MARKER = "max_tries"
+BLOCK_CACHE_SIZE = 64
+PRECOND_STATS_FILE = "precond_stats.json"
 
 logger = getLogger(__name__)
 
@@ -37,6 +45,7 @@ STAMP = TimeStamp().getTimeStamp()
 LOGFILE: str
 RESFILE: str
 PROP_EXEC_RESFILE: str
+TRACEFILE: str
 
 def precondition(precond: Callable[[Any], bool]) -> Callable:
     """the decorator @precondition
@@ -138,6 +147,36 @@ class Options:
     act_blacklist_file: str = None
     # Extra args
     extra_args: List[str] = None
+    # the backend to compute the covered widgets. "numpy" requires numpy installed
+    covered_backend: Literal["rtree", "numpy"] = "rtree"
+    # cache the precondition results of this many screens (0 to disable)
+    precond_cache_size: int = 0
+    # only send the block widgets to fastbot when they change (requires fastbot support)
+    block_delta: bool = False
+    # send the next monkey event while checking the preconds of the current one
+    pipeline: bool = False
+    # send this many monkey events in one request when no property can be executed (1 to disable)
+    batch_steps: int = 1
+    # only get the fingerprints of the intermediate hierarchies in a batch (use with precond_cache_size)
+    batch_fingerprints: bool = False
+    # stream the screenshots from device in tar archives
+    tar_sync: bool = False
+    # the fastbot log is written when this many bytes are buffered
+    log_buffer_size: int = 64 * 1024
+    # rotate the fastbot log when it exceeds this size (MB). 0 for no rotation
+    log_max_size: int = 0
+    # the number of the rotated fastbot logs to keep
+    log_backups: int = 3
+    # compress the fastbot log ("gzip" or "zstd")
+    log_compress: Literal["none", "gzip", "zstd"] = "none"
+    # evaluate the preconditions in this many worker processes. 0 for evaluating them serially
+    precond_workers: int = 0
+    # evaluate the cheap and usually false preconditions first, by the statistics of the previous steps and runs
+    adaptive_preconds: bool = False
+    # the policy selecting the property to execute among the satisfied ones (see kea2.scheduler)
+    scheduler: Literal["random", "least-executed", "fair", "novelty"] = "random"
+    # record the time spent in the startup and every step into a Chrome trace file (trace_*.json)
+    trace: bool = False
 
     def __setattr__(self, name, value):
         if value is None:
@@ -156,8 +195,9 @@ class Options:
                 target_device["transport_id"] = self.transport_id
             self.Driver.setDevice(target_device)
             ADBDevice.setDevice(self.serial, self.transport_id)
+            self.Driver.setStaticCheckerOptions(covered_backend=self.covered_backend)
             
-        global LOGFILE, RESFILE, PROP_EXEC_RESFILE, STAMP
+        global LOGFILE, RESFILE, PROP_EXEC_RESFILE, TRACEFILE, STAMP
         if self.log_stamp:
             illegal_chars = ['/', '\\', ':', '*', '?', '"', '<', '>', '|', '\n', '\r', '\t', '\0']
             for char in illegal_chars:
@@ -173,6 +213,7 @@ class Options:
         LOGFILE = f"fastbot_{STAMP}.log"
         RESFILE = f"result_{STAMP}.json"
         PROP_EXEC_RESFILE = f"property_exec_info_{STAMP}.json"
+        TRACEFILE = f"trace_{STAMP}.json"
 
         self.profile_period = int(self.profile_period)
         if self.profile_period < 1:
@@ -182,6 +223,40 @@ class Options:
         if self.throttle < 0:
             raise ValueError("--throttle should be greater than or equal to 0")
 
+        self.precond_cache_size = int(self.precond_cache_size)
+        if self.precond_cache_size < 0:
+            raise ValueError("--precond-cache-size should be greater than or equal to 0")
+
+        self.batch_steps = int(self.batch_steps)
+        if self.batch_steps < 1:
+            raise ValueError("--batch-steps should be greater than 0")
+        if self.batch_steps > 1 and self.pipeline:
+            raise ValueError("--batch-steps can not be used with --pipeline")
+
+        self.log_buffer_size = int(self.log_buffer_size)
+        if self.log_buffer_size < 0:
+            raise ValueError("--log-buffer-size should be greater than or equal to 0")
+        self.log_max_size = int(self.log_max_size)
+        if self.log_max_size < 0:
+            raise ValueError("--log-max-size should be greater than or equal to 0")
+        self.log_backups = int(self.log_backups)
+        if self.log_backups < 0:
+            raise ValueError("--log-backups should be greater than or equal to 0")
+        if self.log_max_size > 0 and self.log_backups < 1:
+            raise ValueError("--log-backups should be greater than 0 when rotating the log (--log-max-size)")
+        if self.log_compress not in ("none", "gzip", "zstd"):
+            raise ValueError(f"--log-compress should be none, gzip or zstd. current: {self.log_compress}")
+
+        self.precond_workers = int(self.precond_workers)
+        if self.precond_workers < 0:
+            raise ValueError("--precond-workers should be greater than or equal to 0")
+
+        if self.scheduler not in SCHEDULERS:
+            raise ValueError(f"--scheduler should be one of {', '.join(SCHEDULERS)}. current: {self.scheduler}")
+
+        if self.covered_backend not in ("rtree", "numpy"):
+            raise ValueError(f"--covered-backend should be rtree or numpy. current: {self.covered_backend}")
+
         _check_package_installation(self.packageNames)
 
 
@@ -227,6 +302,9 @@ class JsonResult(TextTestResult):
     res: PBTTestResult
     lastExecutedInfo: PropertyExecutionInfo
     executionInfoStore: PropertyExecutionInfoStore = deque()
+    # the properties whose statistics changed since the last flush
+    _changed: Set[PropName] = set()
+    _store: Optional[ResultStore] = None
 
     @classmethod
     def setProperties(cls, allProperties: Dict):
@@ -234,21 +312,43 @@ class JsonResult(TextTestResult):
         for testCase in allProperties.values():
             cls.res[getFullPropName(testCase)] = PropStatistic()
 
-    def flushResult(self):
+    def flushResult(self, compact: bool = False):
+        """
+        Append the changed statistics to the result journal, and compact it into the
+        result file periodically (or if compact).
+        """
         global RESFILE, PROP_EXEC_RESFILE
-        json_res = dict()
-        for propName, propStatitic in self.res.items():
-            json_res[propName] = asdict(propStatitic)
-        with open(RESFILE, "w", encoding="utf-8") as fp:
-            json.dump(json_res, fp, indent=4)
+        if self._store is None:
+            JsonResult._store = ResultStore(RESFILE, PROP_EXEC_RESFILE)
+            atexit.register(self.closeResult)
+
+        if compact or self._store.needCompact():
+            self._store.compact(self._jsonResult())
+        else:
+            self._store.append((propName, asdict(self.res[propName])) for propName in self._changed)
+        self._changed.clear()
 
         while self.executionInfoStore:
             execInfo = self.executionInfoStore.popleft()
-            with open(PROP_EXEC_RESFILE, "a", encoding="utf-8") as fp:
-                fp.write(f"{json.dumps(asdict(execInfo))}\n")
+            self._store.appendExecInfo(asdict(execInfo))
+        self._store.flush()
+
+    def closeResult(self):
+        """
+        Flush the results into the result file and close the result store.
+        """
+        if self._store is None:
+            return
+        self.flushResult(compact=True)
+        self._store.close()
+        JsonResult._store = None
+
+    def _jsonResult(self):
+        return {propName: asdict(propStatitic) for propName, propStatitic in self.res.items()}
 
     def addExcuted(self, test: TestCase, stepsCount: int):
         self.res[getFullPropName(test)].executed += 1
+        self._changed.add(getFullPropName(test))
 
         self.lastExecutedInfo = PropertyExecutionInfo(
             propName=getFullPropName(test),
@@ -259,16 +359,19 @@ class JsonResult(TextTestResult):
 
     def addPrecondSatisfied(self, test: TestCase):
         self.res[getFullPropName(test)].precond_satisfied += 1
+        self._changed.add(getFullPropName(test))
 
     def addFailure(self, test, err):
         super().addFailure(test, err)
         self.res[getFullPropName(test)].fail += 1
+        self._changed.add(getFullPropName(test))
         self.lastExecutedInfo.state = "fail"
         self.lastExecutedInfo.tb = self._exc_info_to_string(err, test)
 
     def addError(self, test, err):
         super().addError(test, err)
         self.res[getFullPropName(test)].error += 1
+        self._changed.add(getFullPropName(test))
         self.lastExecutedInfo.state = "error"
         self.lastExecutedInfo.tb = self._exc_info_to_string(err, test)
 
@@ -280,6 +383,9 @@ class JsonResult(TextTestResult):
 
     def getExcuted(self, test: TestCase):
         return self.res[getFullPropName(test)].executed
+
+    def getStatistic(self, test: TestCase) -> PropStatistic:
+        return self.res[getFullPropName(test)]
     
     def logSummary(self):
         fails = sum(_.fail for _ in self.res.values())
@@ -288,12 +394,119 @@ class JsonResult(TextTestResult):
         logger.info(f"[Property Exectution Summary] Errors:{errors}, Fails:{fails}")
 
 
+class PreconditionCache:
+    """
+    LRU cache of the precondition results keyed by the fingerprint of the hierarchy.
+    The properties whose preconditions access the device (not only the static hierarchy)
+    are never cached.
+    """
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.uncacheable: Set[PropName] = set()
+        self._cache: "OrderedDict[str, Dict[PropName, bool]]" = OrderedDict()
+
+    def get(self, fingerprint: str) -> Optional[Dict[PropName, bool]]:
+        res = self._cache.get(fingerprint)
+        if res is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._cache.move_to_end(fingerprint)
+        return res
+
+    def update(self, fingerprint: str, res: Dict[PropName, bool]):
+        self._cache.setdefault(fingerprint, dict()).update(res)
+        self._cache.move_to_end(fingerprint)
+        if len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    def setUncacheable(self, propName: PropName):
+        if propName in self.uncacheable:
+            return
+        logger.info(f"Precondition of {propName} accesses the device. Not cached.")
+        self.uncacheable.add(propName)
+        for res in self._cache.values():
+            res.pop(propName, None)
+
+
+class PrecondStatistics:
+    """
+    The pass rates and evaluation times of the preconditions (--adaptive-preconds).
+
+    The preconditions of a property are a conjunction. They are evaluated in the ascending
+    order of cost / (1 - pass rate), so the cheap and usually false ones come first. The
+    preconditions never evaluated keep their declaration order, before the others.
+    The statistics are saved across the runs.
+    """
+    def __init__(self, stats_file: Optional[Path] = None):
+        self.stats_file = stats_file
+        # "<propName>#<index of the precond>" -> [evaluated, passed, seconds]
+        self._stats: Dict[str, List[float]] = dict()
+        if stats_file is not None and Path(stats_file).exists():
+            try:
+                with open(stats_file, "r", encoding="utf-8") as fp:
+                    self._stats = json.load(fp)
+                logger.info(f"Loaded the precondition statistics from {stats_file}")
+            except (OSError, ValueError) as e:
+                logger.warning(f"Failed to load the precondition statistics from {stats_file}: {e}")
+
+    @staticmethod
+    def key(propName: PropName, idx: int) -> str:
+        return f"{propName}#{idx}"
+
+    def record(self, key: str, passed: bool, seconds: float):
+        stat = self._stats.get(key)
+        if stat is None:
+            stat = self._stats[key] = [0, 0, 0.0]
+        stat[0] += 1
+        stat[1] += passed
+        stat[2] += seconds
+
+    def _rank(self, key: str) -> float:
+        stat = self._stats.get(key)
+        if stat is None:
+            return 0.0
+        evaluated, passed, seconds = stat
+        # Laplace smoothing, a precondition always passed so far is still ranked by its cost
+        pass_rate = (passed + 1) / (evaluated + 2)
+        return seconds / evaluated / (1 - pass_rate)
+
+    def order(self, propName: PropName, count: int) -> List[int]:
+        """
+        The order to evaluate the preconditions of the property.
+        """
+        if count < 2:
+            return list(range(count))
+        return sorted(range(count), key=lambda idx: self._rank(self.key(propName, idx)))
+
+    def save(self):
+        if self.stats_file is None:
+            return
+        tmp_file = Path(f"{self.stats_file}.tmp")
+        with open(tmp_file, "w", encoding="utf-8") as fp:
+            json.dump(self._stats, fp)
+        os.replace(tmp_file, self.stats_file)
+        logger.info(f"Precondition statistics saved to {self.stats_file}")
+
+
 class KeaTestRunner(TextTestRunner):
 
     resultclass: JsonResult
     allProperties: PropertyStore
     options: Options = None
     _block_funcs: Dict[Literal["widgets", "trees"], List[Callable]] = None
+    _precondCache: PreconditionCache = None
+    _precondPool: Optional[PrecondPool] = None
+    _precondStats: Optional[PrecondStatistics] = None
+    _scheduler: PropertyScheduler = None
+    # the properties reached their max_tries, never evaluated again
+    _retired: Set[PropName] = frozenset()
+    # the hierarchy of the current screen, None if it may be stale
+    _lastHierarchy: Optional[str] = None
+    # the monkey events of the batches after the rewound steps count (see _stepMonkeyBatch)
+    _rewoundSteps: int = 0
 
     @classmethod
     def setOptions(cls, options: Options):
@@ -307,10 +520,11 @@ class KeaTestRunner(TextTestRunner):
     def _setOuputDir(self):
         output_dir = Path(self.options.output_dir).absolute()
         output_dir.mkdir(parents=True, exist_ok=True)
-        global LOGFILE, RESFILE, PROP_EXEC_RESFILE
+        global LOGFILE, RESFILE, PROP_EXEC_RESFILE, TRACEFILE
         LOGFILE = output_dir / Path(LOGFILE)
         RESFILE = output_dir / Path(RESFILE)
         PROP_EXEC_RESFILE = output_dir / Path(PROP_EXEC_RESFILE)
+        TRACEFILE = output_dir / Path(TRACEFILE)
         logger.info(f"Log file: {LOGFILE}")
         logger.info(f"Result file: {RESFILE}")
         logger.info(f"Property execution info file: {PROP_EXEC_RESFILE}")
@@ -324,6 +538,25 @@ class KeaTestRunner(TextTestRunner):
             logger.warning("[Warning] No property has been found.")
 
         self._setOuputDir()
+        if self.options.trace:
+            startTracing(TRACEFILE)
+
+        self._blockCache: "OrderedDict[str, Dict[str, List[str]]]" = OrderedDict()
+
+        if self.options.precond_cache_size > 0:
+            self._precondCache = PreconditionCache(self.options.precond_cache_size)
+
+        self._retired = frozenset()
+        self._scheduler = makeScheduler(self.options.scheduler)
+        if self.options.adaptive_preconds:
+            # shared by the runs with the same output dir
+            self._precondStats = PrecondStatistics(Path(self.options.output_dir).parent / PRECOND_STATS_FILE)
+
+        if self.options.precond_workers > 0 and self.allProperties:
+            # forked before starting any threads
+            self._precondPool = PrecondPool(
+                self.options.precond_workers, self.options.Driver, self.options.driverName, self.allProperties
+            )
 
         JsonResult.setProperties(self.allProperties)
         self.resultclass = JsonResult
@@ -350,91 +583,44 @@ class KeaTestRunner(TextTestRunner):
                         message=r"Please use assert\w+ instead.",
                     )
 
-            fb = FastbotManager(self.options, LOGFILE)
-            fb.start()
+            with span("startup", "startup"):
+                with span("connect adb", "startup"):
+                    fb = FastbotManager(self.options, LOGFILE)
+                # detect the fastbot errors from the output in memory, besides writing the log file
+                log_watcher = LogWatcher()
+                fb.add_log_sink(log_watcher)
+                fb.start()
 
-            log_watcher = LogWatcher(LOGFILE)
-            
-            if self.options.agent == "u2":
-                # initialize the result.json file
-                result.flushResult()
-                # setUp for the u2 driver
-                self.scriptDriver = self.options.Driver.getScriptDriver()
-                fb.check_alive()
-                
-                fb.init(options=self.options, stamp=STAMP)
+                if self.options.agent == "u2":
+                    # initialize the result.json file
+                    result.flushResult()
+                    # setUp for the u2 driver
+                    with span("connect u2", "startup"):
+                        self.scriptDriver = self.options.Driver.getScriptDriver()
+                    with span("check_alive", "startup"):
+                        fb.check_alive()
+                    with span("init", "startup"):
+                        fb.init(options=self.options, stamp=STAMP)
 
+            if self.options.agent == "u2":
                 resultSyncer = ResultSyncer(fb.device_output_dir, self.options)
                 resultSyncer.run()
 
-                end_by_remote = False
-                self.stepsCount = 0
-                while self.stepsCount < self.options.maxStep:
-
-                    self.stepsCount += 1
-                    logger.info("Sending monkeyEvent {}".format(
-                        f"({self.stepsCount} / {self.options.maxStep})" if self.options.maxStep != float("inf")
-                        else f"({self.stepsCount})"
-                        )
-                    )
-
-                    try:
-                        xml_raw = fb.stepMonkey(self._monkeyStepInfo)
-                        propsSatisfiedPrecond = self.getValidProperties(xml_raw, result)
-                    except u2.HTTPError:
-                        logger.info("Connection refused by remote.")
-                        if fb.get_return_code() == 0:
-                            logger.info("Exploration times up (--running-minutes).")
-                            end_by_remote = True
-                            break
-                        raise RuntimeError("Fastbot Aborted.")
-
-                    if self.options.profile_period and self.stepsCount % self.options.profile_period == 0:
-                        resultSyncer.sync_event.set()
-
-                    # Go to the next round if no precond satisfied
-                    if len(propsSatisfiedPrecond) == 0:
-                        continue
-
-                    # get the random probability p
-                    p = random.random()
-                    propsNameFilteredByP = []
-                    # filter the properties according to the given p
-                    for propName, test in propsSatisfiedPrecond.items():
-                        result.addPrecondSatisfied(test)
-                        if getattr(test, "p", 1) >= p:
-                            propsNameFilteredByP.append(propName)
-
-                    if len(propsNameFilteredByP) == 0:
-                        print("Not executed any property due to probability.", flush=True)
-                        continue
-
-                    execPropName = random.choice(propsNameFilteredByP)
-                    test = propsSatisfiedPrecond[execPropName]
-                    # Dependency Injection. driver when doing scripts
-                    self.scriptDriver = self.options.Driver.getScriptDriver()
-                    setattr(test, self.options.driverName, self.scriptDriver)
-                    print("execute property %s." % execPropName, flush=True)
-
-                    result.addExcuted(test, self.stepsCount)
-                    fb.logScript(result.lastExecutedInfo)
-                    try:
-                        test(result)
-                    finally:
-                        result.printErrors()
-
-                    result.updateExectedInfo()
-                    fb.logScript(result.lastExecutedInfo)
-                    result.flushResult()
+                end_by_remote = self._runSteps(fb, result, resultSyncer)
 
                 if not end_by_remote:
                     fb.stopMonkey()
-                result.flushResult()
+                result.closeResult()
                 resultSyncer.close()
                 
             fb.join()
             print(f"Finish sending monkey events.", flush=True)
             log_watcher.close()
+            if self._precondPool is not None:
+                self._precondPool.close()
+            if self._precondStats is not None:
+                self._precondStats.save()
+            stopTracing()
 
         # Source code from unittest Runner
         # process the result
@@ -472,16 +658,181 @@ class KeaTestRunner(TextTestRunner):
         self.stream.flush()
         
         result.logSummary()
+        self._scheduler.logStatistics()
+        if self._precondCache is not None:
+            logger.info(
+                f"[Precondition Cache] hits: {self._precondCache.hits}, misses: {self._precondCache.misses}"
+            )
         return result
 
+    def _runSteps(self, fb: FastbotManager, result: JsonResult, resultSyncer: ResultSyncer) -> bool:
+        """send the monkey events and execute the properties
+
+        Returns:
+            bool: whether the exploration is ended by fastbot (--running-minutes)
+        """
+        end_by_remote = False
+        self.stepsCount = 0
+        self._rewoundSteps = 0
+        profiled = 0
+        # the in-flight /stepMonkey request of the next step (pipeline mode)
+        inflight: Optional[Future] = None
+        # no prefetch for the step after a rollback
+        serialStep = False
+        # the property selected on the rolled back step, executed on the next one if still satisfied
+        deferredPropName: Optional[PropName] = None
+        executor = ThreadPoolExecutor(max_workers=1) if self.options.pipeline else None
+        # batch the next monkey events if no precond satisfied on the current screen
+        batchable = False
+        try:
+            while self.stepsCount < self.options.maxStep:
+
+                self.stepsCount += 1
+                deferred, deferredPropName = deferredPropName, None
+                with span("step", step=self.stepsCount):
+                    logger.info("Sending monkeyEvent {}".format(
+                        f"({self.stepsCount} / {self.options.maxStep})" if self.options.maxStep != float("inf")
+                        else f"({self.stepsCount})"
+                        )
+                    )
+
+                    try:
+                        if inflight is None and batchable:
+                            xml_raw = self._stepMonkeyBatch(fb, result)
+                        elif inflight is None:
+                            xml_raw = fb.stepMonkey(self._monkeyStepInfo)
+                        else:
+                            future, inflight = inflight, None
+                            with span("wait stepMonkey"):
+                                xml_raw = future.result()
+                        self._lastHierarchy = xml_raw
+                        if executor and not serialStep and self.stepsCount < self.options.maxStep:
+                            # send the next step while checking the preconds of this one
+                            stepInfo = self._monkeyStepInfo
+                            stepInfo["steps_count"] = self.eventsCount + 1
+                            inflight = executor.submit(fb.stepMonkey, stepInfo)
+                        serialStep = False
+                        propsSatisfiedPrecond = self.getValidProperties(xml_raw, result)
+                    except u2.HTTPError:
+                        logger.info("Connection refused by remote.")
+                        if fb.get_return_code() == 0:
+                            logger.info("Exploration times up (--running-minutes).")
+                            end_by_remote = True
+                            break
+                        raise RuntimeError("Fastbot Aborted.")
+
+                    # fastbot profiles every profile_period events (a batch may cross the period)
+                    if self.options.profile_period and self.eventsCount // self.options.profile_period > profiled:
+                        profiled = self.eventsCount // self.options.profile_period
+                        resultSyncer.sync_event.set()
+
+                    # Go to the next round if no precond satisfied
+                    batchable = (
+                        self.options.batch_steps > 1 and fb.batch_supported and len(propsSatisfiedPrecond) == 0
+                    )
+                    if len(propsSatisfiedPrecond) == 0:
+                        continue
+
+                    # the preconds are satisfied on this hierarchy, even if it is rolled back below
+                    for test in propsSatisfiedPrecond.values():
+                        result.addPrecondSatisfied(test)
+
+                    if deferred in propsSatisfiedPrecond:
+                        # already selected (and drawn against @prob) on the rolled back step
+                        execPropName = deferred
+                    else:
+                        execPropName = self._selectProperty(propsSatisfiedPrecond, result)
+
+                    if execPropName is not None and inflight is not None:
+                        # Rollback. The device has left the screen of this hierarchy. Don't execute
+                        # the property here, wait for the next step and execute it there if its
+                        # preconds still hold.
+                        logger.info("Property may be executed. Wait for the in-flight step.")
+                        serialStep = True
+                        deferredPropName = execPropName
+                        continue
+
+                    if execPropName is None:
+                        print("Not executed any property due to probability.", flush=True)
+                        continue
+
+                    test = propsSatisfiedPrecond[execPropName]
+                    # Dependency Injection. driver when doing scripts
+                    self.scriptDriver = self.options.Driver.getScriptDriver()
+                    setattr(test, self.options.driverName, self.scriptDriver)
+                    print("execute property %s." % execPropName, flush=True)
+
+                    result.addExcuted(test, self.eventsCount)
+                    fb.logScript(result.lastExecutedInfo)
+                    # the property changes the screen
+                    self._lastHierarchy = None
+                    try:
+                        with span("property", prop=execPropName):
+                            test(result)
+                    finally:
+                        result.printErrors()
+
+                    result.updateExectedInfo()
+                    self._scheduler.onExecuted(execPropName, result.lastExecutedInfo)
+                    fb.logScript(result.lastExecutedInfo)
+                    with span("flushResult"):
+                        result.flushResult()
+        finally:
+            if inflight is not None:
+                # not sent yet, or wait for the response before the device is torn down
+                inflight.cancel()
+            if executor:
+                executor.shutdown(wait=True)
+        return end_by_remote
+
+    def _stepMonkeyBatch(self, fb: FastbotManager, result: JsonResult) -> str:
+        """send a batch of monkey events, and rewind the steps count to the first event
+        where a property could have been executed. The events after it are still executed
+        by fastbot, and counted in eventsCount.
+
+        Returns:
+            str: the hierarchy of the last event
+        """
+        start = self.stepsCount
+        batch_size = int(min(self.options.batch_steps, self.options.maxStep - start + 1))
+        fingerprints = self.options.batch_fingerprints
+        intermediates, xml_raw = fb.stepMonkeyBatch(self._monkeyStepInfo, batch_size, fingerprints)
+        counted = len(intermediates)
+        for i, hierarchy in enumerate(intermediates):
+            if self._mayExecute(hierarchy, fingerprints, result):
+                counted = i
+                break
+        self.stepsCount = start + counted
+        self._rewoundSteps += len(intermediates) - counted
+        logger.info(f"Batched {len(intermediates) + 1} monkey events. Counted as {counted + 1} steps.")
+        return xml_raw
+
+    def _mayExecute(self, hierarchy: str, isFingerprint: bool, result: JsonResult) -> bool:
+        """check if any property could be executed on the hierarchy (or its fingerprint)
+        """
+        if not isFingerprint:
+            return len(self.getValidProperties(hierarchy, result, verbose=False)) > 0
+        # only the cached preconds of a fingerprint are known
+        cachedRes = self._precondCache.get(hierarchy) if self._precondCache is not None else None
+        if cachedRes is None or self._precondCache.uncacheable:
+            return True
+        return any(valid for propName, valid in cachedRes.items() if propName not in self._retired)
+
+    @property
+    def eventsCount(self) -> int:
+        """the monkey events executed by fastbot (its steps count), including the rewound ones
+        """
+        return self.stepsCount + self._rewoundSteps
+
     @property
     def _monkeyStepInfo(self):
         r = self._get_block_widgets()
-        r["steps_count"] = self.stepsCount
+        r["steps_count"] = self.eventsCount
         return r
     
     def _get_block_widgets(self):
-        block_dict = self._getBlockedWidgets()
+        with span("blocked widgets"):
+            block_dict = self._getBlockedWidgets()
         block_widgets: List[str] = block_dict['widgets']
         block_trees: List[str] = block_dict['trees']
         logger.debug(f"Blocking widgets: {block_widgets}")
@@ -491,42 +842,123 @@ class KeaTestRunner(TextTestRunner):
             "block_trees": block_trees
         }
 
-    def getValidProperties(self, xml_raw: str, result: JsonResult) -> PropertyStore:
+    def _selectProperty(self, propsSatisfiedPrecond: PropertyStore, result: JsonResult) -> Optional[PropName]:
+        """select the property to execute, filtered by the random probability p
+        """
+        # get the random probability p
+        p = random.random()
+        # filter the properties according to the given p
+        propsNameFilteredByP = [
+            propName for propName, test in propsSatisfiedPrecond.items()
+            if getattr(getattr(test, propName), PROP_MARKER, 1) >= p
+        ]
+        if len(propsNameFilteredByP) == 0:
+            return None
+        if len(propsNameFilteredByP) == 1:
+            return propsNameFilteredByP[0]
+        return self._scheduler.choose(propsNameFilteredByP, propsSatisfiedPrecond, result)
+
+    def _checkPreconds(self, test: TestCase, prop: Callable, staticCheckerDriver) -> bool:
+        """check if all the preconds of the property passed on the static checker
+        """
+        if self._precondStats is None:
+            order = range(len(prop.preconds))
+        else:
+            order = self._precondStats.order(getFullPropName(test), len(prop.preconds))
+        for idx in order:
+            precond = prop.preconds[idx]
+            # Dependency injection. Static driver checker for precond
+            setattr(test, self.options.driverName, staticCheckerDriver)
+            # excecute the precond
+            start = time.perf_counter()
+            try:
+                passed = bool(precond(test))
+            except u2.UiObjectNotFoundError as e:
+                passed = False
+            except Exception as e:
+                logger.error(f"Error when checking precond: {getFullPropName(test)}")
+                traceback.print_exc()
+                return False
+            if self._precondStats is not None:
+                self._precondStats.record(
+                    PrecondStatistics.key(getFullPropName(test), idx), passed, time.perf_counter() - start
+                )
+            if not passed:
+                return False
+        return True
+
+    def _activeProperties(self, result: JsonResult) -> PropertyStore:
+        """the properties not reached their max_tries. The others are retired.
+        """
+        active: PropertyStore = dict()
+        for propName, test in self.allProperties.items():
+            if propName in self._retired:
+                continue
+            if result.getExcuted(test) >= getattr(getattr(test, propName), MAX_TRIES_MARKER, float("inf")):
+                print(f"{getFullPropName(test)} has reached its max_tries. Retired.", flush=True)
+                self._retired = self._retired | {propName}
+                continue
+            active[propName] = test
+        return active
+
+    def getValidProperties(self, xml_raw: str, result: JsonResult, verbose: bool = True) -> PropertyStore:
+        with span("preconditions"):
+            validProps = self._getValidProperties(xml_raw, result)
+
+        if not verbose:
+            return validProps
+
+        print(f"{len(validProps)} precond satisfied.", flush=True)
+        if len(validProps) > 0:
+            print("[INFO] Valid properties:",flush=True)
+            print("\n".join([f'                - {getFullPropName(p)}' for p in validProps.values()]), flush=True)
+        return validProps
+
+    def _getValidProperties(self, xml_raw: str, result: JsonResult) -> PropertyStore:
+        cachedRes = None
+        if self._precondCache is not None:
+            fingerprint = getHierarchyFingerprint(xml_raw)
+            cachedRes = self._precondCache.get(fingerprint)
+            newRes = dict()
+
+        staticCheckerDriver = None
+        activeProps = self._activeProperties(result)
 
-        staticCheckerDriver = self.options.Driver.getStaticChecker(hierarchy=xml_raw)
+        evaluated: Dict[PropName, bool] = dict()
+        if self._precondPool is not None and self._precondPool.available:
+            pending = [p for p in activeProps if cachedRes is None or p not in cachedRes]
+            if pending:
+                # the undetermined ones are evaluated below
+                with span("precond workers"):
+                    evaluated, _ = self._precondPool.evaluate(xml_raw, pending)
 
         validProps: PropertyStore = dict()
-        for propName, test in self.allProperties.items():
-            valid = True
+        for propName, test in activeProps.items():
             prop = getattr(test, propName)
-            # check if all preconds passed
-            for precond in prop.preconds:
-                # Dependency injection. Static driver checker for precond
-                setattr(test, self.options.driverName, staticCheckerDriver)
-                # excecute the precond
-                try:
-                    if not precond(test):
-                        valid = False
-                        break
-                except u2.UiObjectNotFoundError as e:
-                    valid = False
-                    break
-                except Exception as e:
-                    logger.error(f"Error when checking precond: {getFullPropName(test)}")
-                    traceback.print_exc()
-                    valid = False
-                    break
+            if cachedRes is not None and propName in cachedRes:
+                valid = cachedRes[propName]
+            elif propName in evaluated:
+                valid = evaluated[propName]
+                if self._precondCache is not None and propName not in self._precondCache.uncacheable:
+                    newRes[propName] = valid
+            else:
+                # only parse the hierarchy when some precond should be evaluated
+                if staticCheckerDriver is None:
+                    staticCheckerDriver = self.options.Driver.getStaticChecker(hierarchy=xml_raw)
+                staticCheckerDriver.live_accessed = False
+                valid = self._checkPreconds(test, prop, staticCheckerDriver)
+                if self._precondCache is not None:
+                    if getattr(staticCheckerDriver, "live_accessed", False):
+                        # the precond depends on the device, not only the hierarchy
+                        self._precondCache.setUncacheable(propName)
+                    elif propName not in self._precondCache.uncacheable:
+                        newRes[propName] = valid
             # if all the precond passed. make it the candidate prop.
             if valid:
-                if result.getExcuted(test) >= getattr(prop, MAX_TRIES_MARKER, float("inf")):
-                    print(f"{getFullPropName(test)} has reached its max_tries. Skip.", flush=True)
-                    continue
                 validProps[propName] = test
 
-        print(f"{len(validProps)} precond satisfied.", flush=True)
-        if len(validProps) > 0:
-            print("[INFO] Valid properties:",flush=True)
-            print("\n".join([f'                - {getFullPropName(p)}' for p in validProps.values()]), flush=True)
+        if self._precondCache is not None and newRes:
+            self._precondCache.update(fingerprint, newRes)
         return validProps
 
     def collectAllProperties(self, test: TestSuite):
@@ -621,20 +1053,42 @@ class KeaTestRunner(TextTestRunner):
     def _getBlockedWidgets(self):
         """
            Executes all blocking functions to get lists of widgets and trees to be blocked during testing.
+           The preconditions are checked on the hierarchy returned by the last step, and the lists are
+           cached by the fingerprint of that hierarchy. The device is only accessed when the hierarchy
+           is stale (first step, or a property has been executed).
 
            Returns:
                dict: A dictionary containing:
                    - 'widgets': List of XPath strings for individual widgets to block
                    - 'trees': List of XPath strings for widget trees to block
            """
+        hierarchy = self._lastHierarchy
+        if hierarchy is None:
+            return self._evalBlockedWidgets(self.options.Driver.getScriptDriver())
+
+        fingerprint = getHierarchyFingerprint(hierarchy)
+        if fingerprint in self._blockCache:
+            self._blockCache.move_to_end(fingerprint)
+            return self._blockCache[fingerprint]
+
+        staticCheckerDriver = self.options.Driver.getStaticChecker(hierarchy=hierarchy)
+        staticCheckerDriver.live_accessed = False
+        result = self._evalBlockedWidgets(staticCheckerDriver)
+        # the preconds depend on the device, not only the hierarchy
+        if not getattr(staticCheckerDriver, "live_accessed", False):
+            self._blockCache[fingerprint] = result
+            if len(self._blockCache) > BLOCK_CACHE_SIZE:
+                self._blockCache.popitem(last=False)
+        return result
+
+    def _evalBlockedWidgets(self, precondDriver):
         def _get_xpath_widgets(func):
             blocked_set = set()
-            script_driver = self.options.Driver.getScriptDriver()
             preconds = getattr(func, PRECONDITIONS_MARKER, [])
 
             def preconds_pass(preconds):
                 try:
-                    return all(precond(script_driver) for precond in preconds)
+                    return all(precond(precondDriver) for precond in preconds)
                 except u2.UiObjectNotFoundError as e:
                     return False
                 except Exception as e:
@@ -138,6 +138,144 @@ def _set_runner_parser(subparsers: "argparse._SubParsersAction[argparse.Argument
         help="Add Activity Blacklist File.",
     )
 
+    parser.add_argument(
+        "--covered-backend",
+        dest="covered_backend",
+        type=str,
+        required=False,
+        default="rtree",
+        choices=["rtree", "numpy"],
+        help="The backend to compute the covered widgets. (`numpy` requires the numpy extra: pip install kea2-python[numpy])",
+    )
+
+    parser.add_argument(
+        "--precond-cache-size",
+        dest="precond_cache_size",
+        type=int,
+        required=False,
+        default=0,
+        help="Cache the precondition results of this many screens. (0 to disable)",
+    )
+
+    parser.add_argument(
+        "--block-delta",
+        dest="block_delta",
+        required=False,
+        action="store_true",
+        default=False,
+        help="Only send the block widgets to fastbot when they change.",
+    )
+
+    parser.add_argument(
+        "--pipeline",
+        dest="pipeline",
+        required=False,
+        action="store_true",
+        default=False,
+        help="Send the next monkey event while checking the preconditions.",
+    )
+
+    parser.add_argument(
+        "--batch-steps",
+        dest="batch_steps",
+        type=int,
+        required=False,
+        default=1,
+        help="Send this many monkey events in one request when no property can be executed. (1 to disable)",
+    )
+
+    parser.add_argument(
+        "--batch-fingerprints",
+        dest="batch_fingerprints",
+        required=False,
+        action="store_true",
+        default=False,
+        help="Only get the fingerprints of the intermediate hierarchies in a batch.",
+    )
+
+    parser.add_argument(
+        "--tar-sync",
+        dest="tar_sync",
+        required=False,
+        action="store_true",
+        default=False,
+        help="Stream the screenshots from device in tar archives when syncing the results.",
+    )
+
+    parser.add_argument(
+        "--log-buffer-size",
+        dest="log_buffer_size",
+        type=int,
+        required=False,
+        default=64 * 1024,
+        help="The fastbot log is written when this many bytes are buffered.",
+    )
+
+    parser.add_argument(
+        "--log-max-size",
+        dest="log_max_size",
+        type=int,
+        required=False,
+        default=0,
+        help="Rotate the fastbot log when it exceeds this size (MB). (0 to disable)",
+    )
+
+    parser.add_argument(
+        "--log-backups",
+        dest="log_backups",
+        type=int,
+        required=False,
+        default=3,
+        help="The number of the rotated fastbot logs to keep. (at least 1 with --log-max-size)",
+    )
+
+    parser.add_argument(
+        "--log-compress",
+        dest="log_compress",
+        type=str,
+        required=False,
+        default="none",
+        choices=["none", "gzip", "zstd"],
+        help="Compress the fastbot log. (`zstd` requires the zstd extra: pip install kea2-python[zstd])",
+    )
+
+    parser.add_argument(
+        "--precond-workers",
+        dest="precond_workers",
+        type=int,
+        required=False,
+        default=0,
+        help="Evaluate the preconditions in this many worker processes. (0 to evaluate them serially)",
+    )
+
+    parser.add_argument(
+        "--adaptive-preconds",
+        dest="adaptive_preconds",
+        required=False,
+        action="store_true",
+        default=False,
+        help="Evaluate the cheap and usually false preconditions of a property first.",
+    )
+
+    parser.add_argument(
+        "--scheduler",
+        dest="scheduler",
+        type=str,
+        required=False,
+        default="random",
+        choices=["random", "least-executed", "fair", "novelty"],
+        help="The policy selecting the property to execute among the satisfied ones.",
+    )
+
+    parser.add_argument(
+        "--trace",
+        dest="trace",
+        required=False,
+        action="store_true",
+        default=False,
+        help="Record the time spent in the startup and every step into a Chrome trace file (trace_*.json).",
+    )
+
     parser.add_argument(
         "extra",
         nargs=argparse.REMAINDER,
@@ -226,6 +364,21 @@ def run(args=None):
         act_whitelist_file=args.act_whitelist_file,
         act_blacklist_file=args.act_blacklist_file,
         extra_args=args.extra,
+        covered_backend=args.covered_backend,
+        precond_cache_size=args.precond_cache_size,
+        block_delta=args.block_delta,
+        pipeline=args.pipeline,
+        batch_steps=args.batch_steps,
+        batch_fingerprints=args.batch_fingerprints,
+        tar_sync=args.tar_sync,
+        log_buffer_size=args.log_buffer_size,
+        log_max_size=args.log_max_size,
+        log_backups=args.log_backups,
+        log_compress=args.log_compress,
+        precond_workers=args.precond_workers,
+        adaptive_preconds=args.adaptive_preconds,
+        scheduler=args.scheduler,
+        trace=args.trace,
     )
 
     KeaTestRunner.setOptions(options)
@@ -0,0 +1,287 @@
+"""
+The sink writing the fastbot log: block buffered, rotated by size and optionally compressed.
+
+The log is rotated like logging.handlers.RotatingFileHandler. When the current file exceeds
+max_bytes (uncompressed), it is renamed to <log>.1 (the older ones to <log>.2, ...) and a new
+file is started. The compressed files have the suffix of the compression (".gz" or ".zst").
+Use readLog to read the log over its files, from the oldest to the newest, and LogFollower to
+follow it while it is written.
+
+The buffered log is written at least every FLUSH_INTERVAL, also when fastbot is quiet (the
+compressed streams are flushed too, so the log can be read while running). Call
+closeOpenSinks before exiting the process without the normal shutdown (os._exit).
+"""
+import codecs
+import gzip
+import os
+import threading
+import time
+import weakref
+from pathlib import Path
+from typing import IO, Iterator, List, Literal, Optional, Union
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from kea2.adbUtils import StreamSink
+from kea2.utils import getLogger
+
+
+logger = getLogger(__name__)
+
+
+SUFFIXES = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+# the buffered log is written at least this often (seconds)
+FLUSH_INTERVAL = 1.0
+READ_CHUNK_SIZE = 1024 * 1024
+_TRUNCATED_ERRORS = (EOFError, OSError) + ((zstandard.ZstdError,) if zstandard else ())
+_COMPRESSED_SUFFIXES = tuple(s for s in SUFFIXES.values() if s)
+
+_openSinks: "weakref.WeakSet[RotatingFileSink]" = weakref.WeakSet()
+
+
+def _segmentPath(log_file: Union[str, Path], idx: int, suffix: str) -> Path:
+    return Path(f"{log_file}{f'.{idx}' if idx else ''}{suffix}")
+
+
+def logSegments(log_file: Union[str, Path]) -> List[Path]:
+    """
+    The existing files of the (rotated) log, from the oldest to the newest.
+    """
+    segments = []
+    idx = 0
+    while True:
+        found = [p for p in (_segmentPath(log_file, idx, s) for s in SUFFIXES.values()) if p.exists()]
+        if not found:
+            break
+        segments.extend(found)
+        idx += 1
+    return segments[::-1]
+
+
+def _openSegment(path: Path) -> IO[bytes]:
+    if path.suffix == ".gz":
+        return gzip.open(path, "rb")
+    if path.suffix == ".zst":
+        if zstandard is None:
+            raise RuntimeError(f"zstandard is required to read {path}. Install it with: pip install kea2-python[zstd]")
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+    return open(path, "rb")
+
+
+def closeOpenSinks():
+    """
+    Write the buffered logs and close the files (e.g., before os._exit on a fatal error).
+    """
+    for sink in list(_openSinks):
+        sink.close()
+
+
+def _inode(path: Path) -> int:
+    return os.stat(path).st_ino
+
+
+def readLog(log_file: Union[str, Path]) -> Iterator[str]:
+    """
+    Read the (rotated, compressed) log chunk by chunk, from the oldest file to the newest.
+    The unfinished end of a compressed file (e.g., killed while writing) is ignored.
+    """
+    for path in logSegments(log_file):
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        with _openSegment(path) as f:
+            # read1 returns the data decompressed so far, keeping most of a truncated file
+            read = getattr(f, "read1", f.read)
+            try:
+                while True:
+                    chunk = read(READ_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield decoder.decode(chunk)
+            except _TRUNCATED_ERRORS as e:
+                logger.warning(f"{path} is truncated: {e}")
+
+
+class LogFollower:
+    """
+    Read the log appended since the last read, following the rotation of RotatingFileSink.
+
+    The followed file is identified by its inode. When it has been rotated, its rest (and the
+    files rotated after it) is read before the new file. The end of a compressed file being
+    written is read as far as it has been flushed. A compressed file is decompressed from its
+    start at every read, which is bounded by the rotation size (--log-max-size).
+    """
+    def __init__(self, log_file: Union[str, Path]):
+        self.log_file = log_file
+        self._ino: Optional[int] = None
+        # the uncompressed bytes read from the followed file
+        self._consumed = 0
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+
+    def read(self) -> Iterator[str]:
+        """
+        Yield the new log chunk by chunk.
+        """
+        try:
+            segments = logSegments(self.log_file)
+            if not segments:
+                return
+            active = segments[-1]
+            if self._ino is not None and _inode(active) != self._ino:
+                # rotated since the last read
+                followed = [idx for idx, p in enumerate(segments) if _inode(p) == self._ino]
+                if followed:
+                    yield from self._readFrom(segments[followed[0]])
+                    rotated = segments[followed[0] + 1:-1]
+                else:
+                    rotated = []
+                for path in rotated:
+                    self._consumed = 0
+                    yield from self._readFrom(path)
+                self._ino = None
+            if self._ino is None:
+                self._ino, self._consumed = _inode(active), 0
+            yield from self._readFrom(active)
+        except FileNotFoundError:
+            # rotated while reading. Continued at the next read
+            return
+
+    def _readFrom(self, path: Path) -> Iterator[str]:
+        skip = self._consumed
+        with _openSegment(path) as f:
+            if not path.name.endswith(_COMPRESSED_SUFFIXES):
+                f.seek(skip)
+                skip = 0
+            read = getattr(f, "read1", f.read)
+            try:
+                while True:
+                    chunk = read(READ_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if skip:
+                        if len(chunk) <= skip:
+                            skip -= len(chunk)
+                            continue
+                        chunk, skip = chunk[skip:], 0
+                    self._consumed += len(chunk)
+                    yield self._decoder.decode(chunk)
+            except _TRUNCATED_ERRORS:
+                # the end of the file being written
+                pass
+
+
+class RotatingFileSink(StreamSink):
+    """
+    Write the output into the log file, block buffered and rotated by size.
+
+    :param buffer_size: the output is written when this many bytes are buffered (or after FLUSH_INTERVAL)
+    :param max_bytes: rotate the log file when it exceeds this size. 0 for no rotation
+    :param backup_count: the number of the rotated files to keep (at least 1 with rotation)
+    :param compress: "none", "gzip" or "zstd" (gzip if zstandard is not installed)
+    """
+    def __init__(
+        self, log_file: Union[str, Path], buffer_size: int = 64 * 1024, max_bytes: int = 0,
+        backup_count: int = 3, compress: Literal["none", "gzip", "zstd"] = "none"
+    ):
+        if compress not in SUFFIXES:
+            raise ValueError(f"Unknown log compression: {compress}")
+        if max_bytes and backup_count < 1:
+            raise ValueError("backup_count should be at least 1 when rotating the log")
+        if compress == "zstd" and zstandard is None:
+            logger.warning("zstandard is not installed (pip install kea2-python[zstd]), compress the log with gzip instead.")
+            compress = "gzip"
+        self.log_file = log_file
+        self.buffer_size = buffer_size
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.compress = compress
+        self.path = _segmentPath(log_file, 0, SUFFIXES[compress])
+
+        self._buffer: List[str] = []
+        self._buffered = 0
+        self._written = 0
+        # data written into the compressed stream, but not flushed out of it
+        self._unsynced = False
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self.f: Optional[IO[bytes]] = self._open()
+
+        _openSinks.add(self)
+        self._closed = threading.Event()
+        self._flusher = threading.Thread(target=self._flushPeriodically, daemon=True)
+        self._flusher.start()
+
+    def _open(self) -> IO[bytes]:
+        if self.compress == "gzip":
+            return gzip.open(self.path, "wb")
+        if self.compress == "zstd":
+            return zstandard.ZstdCompressor().stream_writer(open(self.path, "wb"), closefd=True)
+        return open(self.path, "wb")
+
+    def write(self, text: str):
+        with self._lock:
+            if self.f is None:
+                return
+            self._buffer.append(text)
+            self._buffered += len(text)
+            if self._buffered >= self.buffer_size or time.monotonic() - self._last_flush >= FLUSH_INTERVAL:
+                self._flush()
+
+    def flush(self):
+        """
+        Write the buffered output, readable from the file.
+        """
+        with self._lock:
+            if self.f is not None:
+                self._flush(sync=True)
+
+    def _flushPeriodically(self):
+        # the log is not left behind when fastbot is quiet
+        while not self._closed.wait(FLUSH_INTERVAL):
+            with self._lock:
+                if (
+                    self.f is not None and (self._buffer or self._unsynced)
+                    and time.monotonic() - self._last_flush >= FLUSH_INTERVAL
+                ):
+                    self._flush(sync=True)
+
+    def _flush(self, sync: bool = False):
+        if self._buffer:
+            data = "".join(self._buffer).encode("utf-8")
+            self._buffer = []
+            self._buffered = 0
+            self.f.write(data)
+            self._written += len(data)
+            self._unsynced = self.compress != "none"
+        # the compressed streams are only flushed periodically, flushing them shrinks the compression
+        if self.compress == "none" or sync:
+            self.f.flush()
+            self._unsynced = False
+        self._last_flush = time.monotonic()
+        if self.max_bytes and self._written >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        self.f.close()
+        suffix = SUFFIXES[self.compress]
+        # the oldest file is overwritten
+        for idx in range(self.backup_count - 1, -1, -1):
+            src = _segmentPath(self.log_file, idx, suffix)
+            if src.exists():
+                os.replace(src, _segmentPath(self.log_file, idx + 1, suffix))
+        self._written = 0
+        self._unsynced = False
+        self.f = self._open()
+
+    def close(self):
+        self._closed.set()
+        with self._lock:
+            if self.f is None:
+                return
+            self._flush()
+            self.f.close()
+            self.f = None
+        _openSinks.discard(self)
+        if self._flusher is not threading.current_thread():
+            self._flusher.join()
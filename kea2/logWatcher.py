@@ -1,93 +1,228 @@
 import re
 import os
+import queue
 import threading
-import time
-from typing import IO
+from typing import List, Optional
+from kea2.adbUtils import StreamSink
+from kea2.logSink import LogFollower, closeOpenSinks
 from kea2.utils import getLogger
 
 
 logger = getLogger(__name__)
 
 
-PATTERN_EXCEPTION = re.compile(r"\[Fastbot\].+Internal\serror\n([\s\S]*)")
-PATTERN_STATISTIC = re.compile(r".+Monkey\sis\sover!\n([\s\S]+)")
+# the first line of the sections in fastbot log
+PATTERN_EXCEPTION = re.compile(r"\[Fastbot\].+Internal\serror$")
+PATTERN_STATISTIC = re.compile(r".+Monkey\sis\sover!$")
+# the lines continuing the stack trace of an exception
+PATTERN_CONTINUATION = re.compile(r"(\s|$|Caused by:|Suppressed:|\.\.\. \d+ more)")
+
+# bounded buffers for the long running (and verbose) fastbot log
+MAX_SECTION_LINES = 200
+MAX_LINE_LENGTH = 64 * 1024
+# chunks of the log received in memory and not parsed yet. The writer waits when it is full
+MAX_PENDING_CHUNKS = 4096
+# a section is complete at the next log record, or if no more log comes within this time (seconds)
+SECTION_IDLE_TIMEOUT = 0.2
 
 
 def thread_excepthook(args):
     print(args.exc_value, flush=True)
+    # os._exit skips the normal shutdown. Keep the end of the fastbot log (e.g., the fatal error)
+    closeOpenSinks()
     os._exit(1)
 
 
+class FastbotLogParser:
+    """
+    Line-oriented incremental parser of the fastbot log.
+
+    A small state machine collects the "Internal error" and "Monkey is over!" sections
+    (at most MAX_SECTION_LINES lines). The other lines are dropped as soon as they are read.
+    The exception section is reported at the first line not continuing its stack trace.
+    """
+    NORMAL, EXCEPTION, STATISTIC = range(3)
 
-class LogWatcher:
+    def __init__(self):
+        self.state = self.NORMAL
+        self.statistic_printed = False
+        self._partial = ""
+        self._section: List[str] = []
+
+    @property
+    def in_section(self):
+        return self.state != self.NORMAL
+
+    def feed(self, content: str):
+        if not content:
+            return
+        lines = (self._partial + content).split("\n")
+        self._partial = lines.pop()[:MAX_LINE_LENGTH]
+        for line in lines:
+            self._feed_line(line.rstrip("\r"))
+        if len(self._section) >= MAX_SECTION_LINES:
+            self.flush()
+
+    def _feed_line(self, line: str):
+        if PATTERN_EXCEPTION.search(line):
+            self._end_section()
+            self.state = self.EXCEPTION
+        elif PATTERN_STATISTIC.search(line):
+            self._end_section()
+            self.state = self.STATISTIC
+        elif self.state == self.EXCEPTION and self._section and not PATTERN_CONTINUATION.match(line):
+            # the next log record. The exception is complete
+            self._end_section()
+        elif self.state != self.NORMAL and len(self._section) < MAX_SECTION_LINES:
+            self._section.append(line[:MAX_LINE_LENGTH])
+
+    def flush(self, final=False):
+        """
+        Report the current section. Called when no more log is coming for now.
+        """
+        if final and self._partial:
+            self._feed_line(self._partial)
+            self._partial = ""
+        if self.state == self.EXCEPTION:
+            self._report_exception()
+        elif self.state == self.STATISTIC:
+            self._report_statistic()
+
+    def _end_section(self):
+        self.flush()
+        self.state = self.NORMAL
+        self._section = []
+
+    def _report_exception(self):
+        exception_body = "\n".join(self._section).strip()
+        if exception_body:
+            raise RuntimeError(
+                "[Error] Fatal Execption while running fastbot:\n" +
+                exception_body +
+                "\nSee fastbot.log for details."
+            )
+
+    def _report_statistic(self):
+        statistic_body = "\n".join(self._section).strip()
+        if statistic_body and not self.statistic_printed:
+            self.statistic_printed = True
+            print(
+                "[INFO] Fastbot exit:\n" +
+                statistic_body
+            , flush=True)
+
+
+class LogWatcher(StreamSink):
+    """
+    Detect the fatal errors and statistics in the fastbot log.
+
+    With a log_file, the file (rotated and compressed by kea2.logSink.RotatingFileSink) is
+    followed, woken up by notify. Without, the watcher is a sink of the fastbot shell (see
+    StreamShell.add_sink) and parses the log from memory.
+    """
 
     def watcher(self, poll_interval=3):
-        self.last_pos = 0
-
-        with open(self.log_file, "r", encoding="utf-8") as fp:
-            while not self.end_flag:
-                self.read_log(fp)
-                time.sleep(poll_interval)
-            
-            time.sleep(0.2)
-            self.read_log(fp)
-        
-    def read_log(self, f: IO):
-        f.seek(self.last_pos)
-        buffer = f.read()
-        self.last_pos = f.tell()
-
-        self.parse_log(buffer)
-
-    def parse_log(self, content):
-        exception_match = PATTERN_EXCEPTION.search(content)
-        if exception_match:
-            exception_body = exception_match.group(1).strip()
-            if exception_body:
-                raise RuntimeError(
-                    "[Error] Fatal Execption while running fastbot:\n" + 
-                    exception_body + 
-                    "\nSee fastbot.log for details."
-                )
-        
-        statistic_match = PATTERN_STATISTIC.search(content)
-        if statistic_match and not self.statistic_printed:
-            statistic_body = statistic_match.group(1).strip()
-            if statistic_body:
-                self.statistic_printed = True
-                print(
-                    "[INFO] Fastbot exit:\n" + 
-                    statistic_body
-                , flush=True)
-
-    def __init__(self, log_file):
-        logger.info(f"Watching log: {log_file}")
+        if self.log_file is None:
+            self._watch(self.read_pending, poll_interval)
+            return
+        follower = LogFollower(self.log_file)
+        self._watch(lambda: self.read_log(follower), poll_interval)
+
+    def _watch(self, read, poll_interval):
+        while not self.end_flag:
+            # woken by the log writer (see notify), or poll the file
+            timeout = SECTION_IDLE_TIMEOUT if self.parser.in_section else poll_interval
+            woken = self._new_log.wait(timeout=timeout)
+            self._new_log.clear()
+            if not read() and not woken and self.parser.in_section:
+                # nothing new for a while, the current section is complete
+                self.parser.flush()
+
+        read()
+        self.parser.flush(final=True)
+
+    def read_log(self, follower: LogFollower) -> bool:
+        """
+        Read and parse the log appended since the last read, chunk by chunk.
+        """
+        read = False
+        for buffer in follower.read():
+            if buffer:
+                read = True
+                self.parser.feed(buffer)
+        return read
+
+    def read_pending(self) -> bool:
+        """
+        Parse the log written into memory since the last read.
+        """
+        read = False
+        while True:
+            try:
+                content = self._pending.get_nowait()
+            except queue.Empty:
+                return read
+            read = True
+            self.parser.feed(content)
+
+    def write(self, text: str):
+        """
+        Receive the log from the fastbot shell. Only buffered here, the log is parsed
+        in the watcher thread. Waits for the watcher if too much log is pending.
+        """
+        if self.log_file is not None:
+            self.notify()
+            return
+        while not self.end_flag:
+            try:
+                self._pending.put(text, timeout=SECTION_IDLE_TIMEOUT)
+                break
+            except queue.Full:
+                # hold the fastbot output in the pipe until the watcher catches up
+                if not self._waited:
+                    self._waited = True
+                    logger.warning("LogWatcher is falling behind, slowing down the fastbot output.")
+                self.notify()
+        self.notify()
+
+    def notify(self):
+        """
+        Wake up the watcher when the log is written.
+        """
+        self._new_log.set()
+
+    @property
+    def statistic_printed(self):
+        return self.parser.statistic_printed
+
+    def __init__(self, log_file=None, poll_interval=3):
+        logger.info(f"Watching log: {log_file if log_file else 'fastbot output'}")
         self.log_file = log_file
         self.end_flag = False
-        self.statistic_printed = False
+        self.parser = FastbotLogParser()
+        self._new_log = threading.Event()
+        self._pending: "queue.Queue[str]" = queue.Queue(maxsize=MAX_PENDING_CHUNKS)
+        self._waited = False
 
         threading.excepthook = thread_excepthook
-        self.t = threading.Thread(target=self.watcher, daemon=True)
+        self.t: Optional[threading.Thread] = threading.Thread(
+            target=self.watcher, args=(poll_interval,), daemon=True
+        )
         self.t.start()
-    
+
     def close(self):
-        logger.info("Close: LogWatcher")
-        self.end_flag = True
-        if self.t:
+        """
+        Stop watching after parsing the remaining log. Also called by the fastbot
+        shell when it exits, so closing twice is fine.
+        """
+        if not self.end_flag:
+            logger.info("Close: LogWatcher")
+            self.end_flag = True
+            self._new_log.set()
+        if self.t and self.t is not threading.current_thread():
             self.t.join()
-        
-        if not self.statistic_printed:
-            self._parse_whole_log()
-    
-    def _parse_whole_log(self):
-        logger.warning(
-            "LogWatcher closed without reading the statistics, parsing the whole log now."
-        )
-        with open(self.log_file, "r", encoding="utf-8") as fp:
-            content = fp.read()
-            self.parse_log(content)
 
 
 if __name__ == "__main__":
     # LogWatcher()
-    pass
\ No newline at end of file
+    pass
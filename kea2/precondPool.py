@@ -0,0 +1,226 @@
+"""
+Evaluate the preconditions in worker processes (--precond-workers).
+
+The workers are forked before the exploration starts, and each of them owns a fixed slice of
+the properties. At every step, the xml hierarchy is published once into shared memory. The
+workers evaluate the preconditions of their properties on a static checker detached from the
+device, and only send back the names of the satisfied ones.
+
+A precondition accessing the device (not only the static hierarchy), or raising an error, is
+reported as undetermined and evaluated again in the main process. The test cases are copied
+into the workers when forking, so the preconditions should not depend on the states changed
+by the properties.
+"""
+import multiprocessing
+import sys
+from multiprocessing import resource_tracker
+from multiprocessing.connection import Connection
+from multiprocessing.shared_memory import SharedMemory
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple, Type
+from unittest import TestCase
+
+from lxml import etree
+
+from kea2.utils import getLogger
+
+if TYPE_CHECKING:
+    from kea2.absDriver import AbstractDriver
+
+
+logger = getLogger(__name__)
+
+
+# the initial size of the shared hierarchy. grows when a larger one is published
+SHARED_HIERARCHY_SIZE = 1024 * 1024
+
+
+def forkAvailable() -> bool:
+    # fork is not available on Windows, and not safe on macOS
+    return "fork" in multiprocessing.get_all_start_methods() and sys.platform != "darwin"
+
+
+def _attach(name: str) -> SharedMemory:
+    try:
+        return SharedMemory(name=name, track=False)
+    except TypeError:
+        # python < 3.13. The segment is owned (and unlinked) by the main process
+        shm = SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+def _evalPreconds(test: TestCase, propName: str, driverName: str, staticChecker) -> Optional[bool]:
+    """
+    Evaluate the preconditions of the property. None if undetermined in the worker.
+    """
+    prop = getattr(test, propName)
+    staticChecker.live_accessed = False
+    for precond in prop.preconds:
+        setattr(test, driverName, staticChecker)
+        try:
+            satisfied = precond(test)
+        except Exception:
+            # evaluated again (and reported) in the main process
+            return None
+        if getattr(staticChecker, "live_accessed", False):
+            return None
+        if not satisfied:
+            return False
+    return True
+
+
+def _worker(
+    conn: Connection, Driver: Type["AbstractDriver"], driverName: str, properties: Dict[str, TestCase]
+):
+    conn.send(Driver.detachStaticChecker())
+    shm: Optional[SharedMemory] = None
+    try:
+        while True:
+            try:
+                task = conn.recv()
+            except EOFError:
+                break
+            if task is None:
+                break
+            name, length, propNames = task
+            if shm is None or shm.name != name:
+                if shm is not None:
+                    shm.close()
+                shm = _attach(name)
+            data = bytes(shm.buf[:length])
+
+            try:
+                staticChecker = Driver.getStaticChecker(hierarchy=etree.fromstring(data))
+            except Exception:
+                conn.send(([], propNames))
+                continue
+
+            satisfied, undetermined = [], []
+            for propName in propNames:
+                valid = _evalPreconds(properties[propName], propName, driverName, staticChecker)
+                if valid is None:
+                    undetermined.append(propName)
+                elif valid:
+                    satisfied.append(propName)
+            conn.send((satisfied, undetermined))
+    finally:
+        if shm is not None:
+            shm.close()
+
+
+class PrecondPool:
+    """
+    The worker processes evaluating the preconditions. Check `available` after creating it:
+    the pool is not available if fork is not supported or the driver can not detach its
+    static checker, then the preconditions should be evaluated serially.
+    """
+    def __init__(
+        self, workers: int, Driver: Type["AbstractDriver"], driverName: str, properties: Dict[str, TestCase]
+    ):
+        self.available = False
+        self._shm: Optional[SharedMemory] = None
+        self._workers: List[Tuple[multiprocessing.Process, Connection]] = []
+        self._owner: Dict[str, int] = dict()
+
+        if not forkAvailable():
+            logger.warning("fork is not available on this platform. Evaluate the preconditions serially.")
+            return
+
+        ctx = multiprocessing.get_context("fork")
+        names = list(properties)
+        workers = max(1, min(workers, len(names)))
+        for idx in range(workers):
+            for propName in names[idx::workers]:
+                self._owner[propName] = idx
+            parent_conn, child_conn = ctx.Pipe()
+            proc = ctx.Process(
+                target=_worker, args=(child_conn, Driver, driverName, properties),
+                name=f"kea2-precond-{idx}", daemon=True
+            )
+            proc.start()
+            child_conn.close()
+            self._workers.append((proc, parent_conn))
+
+        if not all(self._hello(conn) for _, conn in self._workers):
+            logger.warning("The static checker can not be detached from the device. Evaluate the preconditions serially.")
+            self.close()
+            return
+        self.available = True
+        logger.info(f"Evaluating the preconditions in {workers} worker processes.")
+
+    @staticmethod
+    def _hello(conn: Connection) -> bool:
+        try:
+            return conn.recv()
+        except (EOFError, OSError):
+            return False
+
+    def _publish(self, data: bytes) -> Tuple[str, int]:
+        if self._shm is None or self._shm.size < len(data):
+            size = max(SHARED_HIERARCHY_SIZE, len(data) * 2)
+            if self._shm is not None:
+                # the workers are idle, they attach the new one with the next task
+                self._shm.close()
+                self._shm.unlink()
+            self._shm = SharedMemory(create=True, size=size)
+        self._shm.buf[:len(data)] = data
+        return self._shm.name, len(data)
+
+    def evaluate(
+        self, hierarchy: str, propNames: List[str]
+    ) -> Tuple[Dict[str, bool], List[str]]:
+        """
+        Evaluate the preconditions of the properties on the hierarchy.
+
+        Returns:
+            the evaluated properties (whether satisfied), and the undetermined ones
+        """
+        name, length = self._publish(hierarchy.encode("utf-8"))
+
+        tasks: Dict[int, List[str]] = dict()
+        for propName in propNames:
+            tasks.setdefault(self._owner[propName], []).append(propName)
+
+        evaluated: Dict[str, bool] = dict()
+        undetermined: List[str] = []
+        sent = []
+        for idx, names in tasks.items():
+            try:
+                self._workers[idx][1].send((name, length, names))
+                sent.append(idx)
+            except OSError:
+                undetermined.extend(names)
+        for idx in sent:
+            names = tasks[idx]
+            try:
+                satisfied, _undetermined = self._workers[idx][1].recv()
+            except (EOFError, OSError):
+                logger.error(f"Precondition worker {idx} exited. Evaluate the preconditions serially.")
+                self.available = False
+                undetermined.extend(names)
+                continue
+            undetermined.extend(_undetermined)
+            satisfied = set(satisfied)
+            skipped = set(_undetermined)
+            for propName in names:
+                if propName not in skipped:
+                    evaluated[propName] = propName in satisfied
+        return evaluated, undetermined
+
+    def close(self):
+        self.available = False
+        for proc, conn in self._workers:
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+            conn.close()
+        for proc, _ in self._workers:
+            proc.join(timeout=5)
+            if proc.is_alive():
+                proc.terminate()
+        self._workers = []
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
@@ -6,6 +6,7 @@ from pathlib import Path
 from typing import Dict, List, Optional, Tuple, Union
 from collections import defaultdict
 
+from kea2.resultStore import readResult
 from kea2.utils import getLogger
 
 logger = getLogger(__name__)
@@ -115,8 +116,7 @@ class TestReportMerger:
             dir_name = result_dir.name  # Get the directory name (e.g., res_2025072011_5048015228)
 
             try:
-                with open(result_file, 'r', encoding='utf-8') as f:
-                    test_results = json.load(f)
+                test_results = readResult(result_file)
 
                 # Merge results for each property
                 for prop_name, prop_result in test_results.items():
@@ -0,0 +1,118 @@
+"""
+Append-only persistence of the property results.
+
+The statistics of the properties changed since the last flush are appended to a journal
+(<result file>.journal) as compact delta records, one json line per property:
+
+    ["<propName>", precond_satisfied, executed, fail, error]
+
+The records hold the new statistics (not the increments), so replaying the journal over the
+snapshot is idempotent. The journal is compacted into the snapshot (the result_*.json read by
+the report tools) periodically and at exit. The snapshot is written into a temporary file and
+renamed with os.replace, so the result file is always complete. Use readResult to read the
+latest results of a run that did not exit normally.
+"""
+import json
+import os
+import time
+from pathlib import Path
+from typing import IO, Dict, Iterable, Optional, Tuple, Union
+
+from kea2.utils import getLogger
+
+
+logger = getLogger(__name__)
+
+
+STAT_FIELDS = ("precond_satisfied", "executed", "fail", "error")
+# compact the journal into the snapshot at least this often (seconds)
+COMPACT_INTERVAL = 60
+
+ResultDict = Dict[str, Dict[str, int]]
+
+
+def _journalPath(res_file: Union[str, Path]) -> Path:
+    return Path(f"{res_file}.journal")
+
+
+def readResult(res_file: Union[str, Path]) -> ResultDict:
+    """
+    Read the result snapshot and replay the journal (if any) over it.
+    """
+    res: ResultDict = dict()
+    res_file = Path(res_file)
+    if res_file.exists():
+        with open(res_file, "r", encoding="utf-8") as fp:
+            res = json.load(fp)
+
+    journal = _journalPath(res_file)
+    if journal.exists():
+        with open(journal, "r", encoding="utf-8") as fp:
+            for line in fp:
+                try:
+                    propName, *stats = json.loads(line)
+                except ValueError:
+                    # the last record is incomplete if the run was killed while writing it
+                    logger.warning(f"Skip the broken record in {journal}: {line.strip()}")
+                    continue
+                res[propName] = dict(zip(STAT_FIELDS, stats))
+    return res
+
+
+class ResultStore:
+    """
+    Keep the result journal and the property execution info file open while running.
+    """
+    def __init__(
+        self, res_file: Union[str, Path], exec_info_file: Union[str, Path],
+        compact_interval: float = COMPACT_INTERVAL
+    ):
+        self.res_file = Path(res_file)
+        self.compact_interval = compact_interval
+        self._journal: Optional[IO] = open(_journalPath(res_file), "a", encoding="utf-8")
+        self._exec_info: Optional[IO] = open(exec_info_file, "a", encoding="utf-8")
+        self._last_compact: Optional[float] = None
+
+    def needCompact(self) -> bool:
+        return self._last_compact is None or time.monotonic() - self._last_compact >= self.compact_interval
+
+    def append(self, stats: Iterable[Tuple[str, Dict[str, int]]]):
+        """
+        Append the new statistics of the changed properties to the journal.
+        """
+        for propName, stat in stats:
+            record = [propName] + [stat[field] for field in STAT_FIELDS]
+            self._journal.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+    def appendExecInfo(self, execInfo: Dict):
+        self._exec_info.write(f"{json.dumps(execInfo)}\n")
+
+    def flush(self):
+        self._journal.flush()
+        self._exec_info.flush()
+
+    def compact(self, res: ResultDict):
+        """
+        Write the whole results into the snapshot atomically and empty the journal.
+        """
+        tmp_file = self.res_file.with_name(self.res_file.name + ".tmp")
+        with open(tmp_file, "w", encoding="utf-8") as fp:
+            json.dump(res, fp, indent=4)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_file, self.res_file)
+        # the records are in the snapshot now (replaying them again is harmless)
+        self._journal.flush()
+        self._journal.truncate(0)
+        self._last_compact = time.monotonic()
+
+    def close(self):
+        """
+        Close the files. The journal is removed (compact before closing).
+        """
+        if self._journal is None:
+            return
+        self._journal.close()
+        self._exec_info.close()
+        self._journal = self._exec_info = None
+        _journalPath(self.res_file).unlink()
@@ -1,13 +1,20 @@
+import os
 from pathlib import Path
+import shlex
+import shutil
+import tarfile
 import threading
 from .adbUtils import ADBDevice
 from .utils import getLogger
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Dict, List, Set, Tuple
 if TYPE_CHECKING:
     from .keaUtils import Options
 
 logger = getLogger(__name__)
 
+# the files per shell command (tar or rm), to keep the command line short
+SYNC_CHUNK = 100
+
 
 class ResultSyncer:
 
@@ -17,6 +24,13 @@ class ResultSyncer:
         self.running = False
         self.thread = None
         self.sync_event = threading.Event()
+        # the bytes of each log file already pulled
+        self._offsets: Dict[str, int] = dict()
+        # the (size, mtime) of the other files already pulled
+        self._pulled: Dict[str, Tuple[int, int]] = dict()
+        self._pulled_screenshots: Set[str] = set()
+        # stream the screenshots in a tar archive (fall back to pulling each file if tar is not available)
+        self.tar_sync = options.tar_sync
 
         ADBDevice.setDevice(serial=options.serial, transport_id=options.transport_id)
         self.dev = ADBDevice()
@@ -51,16 +65,105 @@ class ResultSyncer:
 
     def _sync_device_data(self):
         """
-        Sync the device data to the local directory.
+        Sync the device data to the local directory incrementally.
+            - log files (*.log): only the appended bytes are pulled.
+            - screenshots (*.png): pulled once, then removed from the device.
+            - other files: pulled when changed.
         """
         try:
             logger.debug("Syncing data")
-
-            self.dev.sync.pull_dir(self.device_output_dir, self.output_dir, exist_ok=True)
-            # pull_file(self.device_output_dir, str(self.output_dir))
-
-            remove_pulled_screenshots = ["find", self.device_output_dir, "-name", '"*.png"', "-delete"]
-            self.dev.shell(remove_pulled_screenshots)
-            # adb_shell(remove_pulled_screenshots)
+            files = self._list_device_files()
+            screenshots = []
+            for remote, (size, mtime) in files.items():
+                if remote.endswith(".png"):
+                    if remote not in self._pulled_screenshots:
+                        screenshots.append(remote)
+                elif remote.endswith(".log"):
+                    self._pull_appended(remote, size)
+                elif self._pulled.get(remote) != (size, mtime):
+                    self.dev.sync.pull(remote, self._local_path(remote, mkdir=True))
+                    self._pulled[remote] = (size, mtime)
+            self._pull_screenshots(screenshots)
         except Exception as e:
             logger.error(f"Error in data sync: {e}")
+
+    def _list_device_files(self) -> Dict[str, Tuple[int, int]]:
+        """
+        list the files in the device output dir with their (size, mtime) in one shell call.
+        """
+        r = self.dev.shell(
+            f"find {shlex.quote(self.device_output_dir)} -type f -exec stat -c '%s %Y %n' {{}} +"
+        )
+        files = dict()
+        for line in r.splitlines():
+            fields = line.split(" ", 2)
+            if len(fields) == 3 and fields[0].isdigit() and fields[1].isdigit():
+                files[fields[2]] = (int(fields[0]), int(fields[1]))
+        return files
+
+    def _local_path(self, remote: str, mkdir=False) -> Path:
+        local = self.output_dir / Path(remote).relative_to(self.device_output_dir)
+        if mkdir:
+            local.parent.mkdir(parents=True, exist_ok=True)
+        return local
+
+    def _pull_appended(self, remote: str, size: int):
+        offset = self._offsets.get(remote, 0)
+        if size == offset:
+            return
+        local = self._local_path(remote, mkdir=True)
+        if size < offset:
+            # the file is rewritten. Pull it again.
+            offset = 0
+        data = self.dev.exec_out(f"tail -c +{offset + 1} {shlex.quote(remote)}")
+        with open(local, "r+b" if offset and local.exists() else "wb") as f:
+            f.seek(offset)
+            f.write(data)
+            f.truncate()
+        self._offsets[remote] = offset + len(data)
+
+    def _pull_screenshots(self, screenshots: List[str]):
+        if self.tar_sync:
+            try:
+                for i in range(0, len(screenshots), SYNC_CHUNK):
+                    self._pull_tar(screenshots[i:i + SYNC_CHUNK])
+                return
+            except (tarfile.TarError, OSError) as e:
+                logger.warning(f"Failed to sync the screenshots with tar: {e}. Pull them one by one.")
+                self.tar_sync = False
+                screenshots = [p for p in screenshots if p not in self._pulled_screenshots]
+
+        for remote in screenshots:
+            self.dev.sync.pull(remote, self._local_path(remote, mkdir=True))
+            self._pulled_screenshots.add(remote)
+        # only remove the pulled ones. New screenshots may be taken during the sync.
+        for i in range(0, len(screenshots), SYNC_CHUNK):
+            self.dev.shell(f"rm -f {' '.join(shlex.quote(p) for p in screenshots[i:i + SYNC_CHUNK])}")
+
+    def _pull_tar(self, screenshots: List[str]):
+        """
+        Stream the screenshots in a tar archive through exec-out, and extract them as they arrive.
+        They are removed from the device in the same command, only if the whole archive is written.
+        """
+        if not screenshots:
+            return
+        names = " ".join(shlex.quote(os.path.relpath(p, self.device_output_dir)) for p in screenshots)
+        c = self.dev.exec_out(
+            f"cd {shlex.quote(self.device_output_dir)} && tar -cf - {names} && rm -f {names}",
+            stream=True,
+        )
+        try:
+            with c.conn.makefile("rb") as f, tarfile.open(fileobj=f, mode="r|") as tar:
+                for member in tar:
+                    name = os.path.normpath(member.name)
+                    if not member.isfile() or os.path.isabs(name) or name.startswith(".."):
+                        continue
+                    remote = f"{self.device_output_dir}/{name}"
+                    with tar.extractfile(member) as src, open(self._local_path(remote, mkdir=True), "wb") as dst:
+                        shutil.copyfileobj(src, dst)
+                    self._pulled_screenshots.add(remote)
+                # read to the end, so the rm is not interrupted by closing the connection
+                while f.read(1 << 16):
+                    pass
+        finally:
+            c.close()
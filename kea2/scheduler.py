@@ -0,0 +1,137 @@
+"""
+Select the property to execute among the ones whose preconditions are satisfied (--scheduler).
+
+The contracts of the decorators are kept by the runner: a property is a candidate with the
+probability given by @prob (one random number per step), and the properties which reached
+their @max_tries are never satisfied. The scheduler only decides among the candidates:
+
+    random:          uniformly (the default)
+    least-executed:  the least executed one first (ties broken randomly)
+    fair:            weighted by (precond_satisfied + 1) / (executed + 1), so the properties
+                     rarely satisfied are not crowded out by the ones satisfied at every step
+    novelty:         weighted by (1 + NOVELTY_BOOST * distinct failures) / (executed + 1), so the
+                     properties finding new failures are executed more, and the ones always
+                     passing less and less
+"""
+import random
+import time
+from abc import ABC, abstractmethod
+from typing import TYPE_CHECKING, Callable, Dict, List, Literal, Set
+
+from kea2.utils import getLogger
+
+if TYPE_CHECKING:
+    from kea2.keaUtils import JsonResult, PropertyExecutionInfo, PropertyStore, PropName, PropStatistic
+
+
+logger = getLogger(__name__)
+
+
+SCHEDULERS = ("random", "least-executed", "fair", "novelty")
+NOVELTY_BOOST = 4
+SECONDS_PER_HOUR = 3600
+
+
+class PropertyScheduler:
+    """
+    The base scheduler, choosing uniformly. Subclasses override choose.
+    """
+    name = "random"
+
+    def __init__(self, rng: random.Random = None):
+        self.rng = rng if rng is not None else random
+        self._start = time.monotonic()
+        # the distinct properties executed in every device-hour (since the scheduler started)
+        self._hourly: List[Set[str]] = [set()]
+
+    def choose(self, candidates: List["PropName"], props: "PropertyStore", result: "JsonResult") -> "PropName":
+        """
+        Choose the property to execute among the candidates (filtered by @prob).
+        """
+        return self.rng.choice(candidates)
+
+    def onExecuted(self, propName: "PropName", execInfo: "PropertyExecutionInfo"):
+        """
+        Called after the property is executed.
+        """
+        hour = int((time.monotonic() - self._start) // SECONDS_PER_HOUR)
+        while len(self._hourly) <= hour:
+            self._hourly.append(set())
+        self._hourly[hour].add(propName)
+
+    def logStatistics(self):
+        hours = max((time.monotonic() - self._start) / SECONDS_PER_HOUR, 1e-9)
+        exercised = set().union(*self._hourly)
+        per_hour = ", ".join(str(len(props)) for props in self._hourly)
+        logger.info(
+            f"[Scheduler] {self.name}: {len(exercised)} distinct properties executed in {hours:.2f} device-hours "
+            f"({len(exercised) / hours:.1f} per device-hour). Distinct properties in every hour: [{per_hour}]"
+        )
+
+
+def _stat(result: "JsonResult", props: "PropertyStore", propName: "PropName") -> "PropStatistic":
+    return result.getStatistic(props[propName])
+
+
+class _WeightedScheduler(PropertyScheduler, ABC):
+    """
+    Choose randomly, weighted by the weight of every candidate.
+    """
+    @abstractmethod
+    def weight(self, propName: "PropName", props: "PropertyStore", result: "JsonResult") -> float:
+        ...
+
+    def choose(self, candidates, props, result):
+        weights = [self.weight(propName, props, result) for propName in candidates]
+        return self.rng.choices(candidates, weights=weights)[0]
+
+
+class LeastExecutedScheduler(PropertyScheduler):
+    name = "least-executed"
+
+    def choose(self, candidates, props, result):
+        executed = {propName: _stat(result, props, propName).executed for propName in candidates}
+        fewest = min(executed.values())
+        return self.rng.choice([propName for propName in candidates if executed[propName] == fewest])
+
+
+class FairScheduler(_WeightedScheduler):
+    name = "fair"
+
+    def weight(self, propName, props, result):
+        stat = _stat(result, props, propName)
+        return (stat.precond_satisfied + 1) / (stat.executed + 1)
+
+
+class NoveltyScheduler(_WeightedScheduler):
+    name = "novelty"
+
+    def __init__(self, rng: random.Random = None):
+        super().__init__(rng)
+        # the distinct failures (the last line of the traceback) of every property
+        self._failures: Dict[str, Set[str]] = dict()
+
+    def weight(self, propName, props, result):
+        novel = len(self._failures.get(propName, ()))
+        return (1 + NOVELTY_BOOST * novel) / (_stat(result, props, propName).executed + 1)
+
+    def onExecuted(self, propName, execInfo):
+        super().onExecuted(propName, execInfo)
+        if execInfo.state in ("fail", "error"):
+            lines = execInfo.tb.strip().splitlines()
+            signature = lines[-1] if lines else execInfo.state
+            self._failures.setdefault(propName, set()).add(signature)
+
+
+_SCHEDULERS: Dict[str, Callable[[], PropertyScheduler]] = {
+    "random": PropertyScheduler,
+    "least-executed": LeastExecutedScheduler,
+    "fair": FairScheduler,
+    "novelty": NoveltyScheduler,
+}
+
+
+def makeScheduler(name: Literal["random", "least-executed", "fair", "novelty"] = "random") -> PropertyScheduler:
+    if name not in _SCHEDULERS:
+        raise ValueError(f"Unknown scheduler: {name}. Should be one of {', '.join(SCHEDULERS)}")
+    return _SCHEDULERS[name]()
@@ -0,0 +1,160 @@
+"""
+Trace where the time goes (--trace).
+
+The spans are recorded with `with span("name"):` and written into a Chrome trace-event file
+(trace_*.json in the output dir), which can be opened in https://ui.perfetto.dev or
+chrome://tracing. The spans of a thread nest by time, so a step shows the /stepMonkey
+request, the hierarchy parsing, the preconditions, the property, etc. inside it.
+
+The events are written in the JSON array format, chunk by chunk while running. The closing
+bracket is optional in this format, so the trace of a killed run can still be opened.
+
+When tracing is disabled, span returns a shared no-op context manager.
+"""
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import nullcontext
+from pathlib import Path
+from typing import IO, ContextManager, Dict, List, Optional, Union
+
+from kea2.utils import getLogger
+
+
+logger = getLogger(__name__)
+
+
+# the events are written when this many are buffered
+FLUSH_EVENTS = 1024
+_NULL_SPAN = nullcontext()
+
+
+class _Span:
+    __slots__ = ("tracer", "name", "cat", "args", "start")
+
+    def __init__(self, tracer: "Tracer", name: str, cat: str, args: Dict):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer._complete(self, time.perf_counter_ns())
+        return False
+
+
+class Tracer:
+    """
+    Record the spans and write them into the trace file.
+    """
+    def __init__(self, trace_file: Union[str, Path]):
+        self.trace_file = Path(trace_file)
+        self.pid = os.getpid()
+        self._origin = time.perf_counter_ns()
+        self._events: List[Dict] = []
+        self._threads = set()
+        self._lock = threading.Lock()
+        # the total time (ns) and count of every span name, for the summary
+        self._totals: Dict[str, List[int]] = defaultdict(lambda: [0, 0])
+        self.f: Optional[IO] = open(self.trace_file, "w", encoding="utf-8")
+        self.f.write("[\n")
+        self._meta("process_name", 0, "kea2")
+
+    def span(self, name: str, cat: str = "kea2", **args) -> ContextManager:
+        return _Span(self, name, cat, args)
+
+    def _meta(self, name: str, tid: int, value: str):
+        self._events.append({"name": name, "ph": "M", "pid": self.pid, "tid": tid, "args": {"name": value}})
+
+    def _complete(self, span: _Span, end: int):
+        tid = threading.get_ident()
+        event = {
+            "name": span.name, "cat": span.cat, "ph": "X", "pid": self.pid, "tid": tid,
+            "ts": (span.start - self._origin) / 1000, "dur": (end - span.start) / 1000,
+        }
+        if span.args:
+            event["args"] = span.args
+        with self._lock:
+            if tid not in self._threads:
+                self._threads.add(tid)
+                self._meta("thread_name", tid, threading.current_thread().name)
+            self._events.append(event)
+            total = self._totals[span.name]
+            total[0] += end - span.start
+            total[1] += 1
+            if len(self._events) >= FLUSH_EVENTS:
+                self._flush()
+
+    def _flush(self):
+        if self.f is None or not self._events:
+            return
+        self.f.write("".join(json.dumps(e, separators=(",", ":")) + ",\n" for e in self._events))
+        self._events = []
+        self.f.flush()
+
+    def logSummary(self):
+        lines = [
+            f"    {name}: {count} spans, {total / 1e6:.1f}ms in total, {total / count / 1e6:.2f}ms on average"
+            for name, (total, count) in sorted(self._totals.items(), key=lambda kv: -kv[1][0])
+        ]
+        logger.info("[Trace] Time spent:\n" + "\n".join(lines))
+
+    def close(self):
+        with self._lock:
+            if self.f is None:
+                return
+            self._flush()
+            # the last event, without the trailing comma
+            end = {"name": "process_sort_index", "ph": "M", "pid": self.pid, "tid": 0, "args": {"sort_index": 0}}
+            self.f.write(json.dumps(end, separators=(",", ":")) + "\n]\n")
+            self.f.close()
+            self.f = None
+        self.logSummary()
+        logger.info(f"Trace saved to {self.trace_file}. Open it in https://ui.perfetto.dev or chrome://tracing")
+
+
+class _NullTracer:
+    def span(self, name: str, cat: str = "kea2", **args) -> ContextManager:
+        return _NULL_SPAN
+
+    def close(self):
+        pass
+
+
+_tracer: Union[Tracer, _NullTracer] = _NullTracer()
+
+
+def span(name: str, cat: str = "kea2", **args) -> ContextManager:
+    """
+    A span of the trace, used as a context manager. No-op when tracing is disabled.
+    """
+    return _tracer.span(name, cat, **args)
+
+
+def startTracing(trace_file: Union[str, Path]) -> Tracer:
+    global _tracer
+    _tracer.close()
+    _tracer = Tracer(trace_file)
+    return _tracer
+
+
+def stopTracing():
+    global _tracer
+    tracer, _tracer = _tracer, _NullTracer()
+    tracer.close()
+
+
+def _disableInChild():
+    # the forked workers (e.g., kea2.precondPool) must not write into the trace file of the parent
+    global _tracer
+    _tracer = _NullTracer()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_disableInChild)
@@ -1,5 +1,7 @@
+import bisect
 import functools
 import random
+from collections import OrderedDict
 import socket
 import time
 from time import sleep
@@ -8,10 +10,15 @@ import adbutils
 import types
 import rtree
 import re
-from typing import Any, Dict, List, Union, Optional
+from typing import Any, Callable, Dict, List, Literal, Set, Tuple, Union, Optional
 from http.client import HTTPResponse
 from lxml import etree
+try:
+    import numpy as np
+except ImportError:
+    np = None
 from .absDriver import AbstractScriptDriver, AbstractStaticChecker, AbstractDriver
+from .tracer import span
 from .adbUtils import list_forwards, remove_forward, create_forward
 from .utils import TimeStamp, getLogger
 
@@ -80,6 +87,141 @@ class U2ScriptDriver(AbstractScriptDriver):
 """
 The definition of U2StaticChecker
 """
+BOOL_PROPS = ["checkable", "checked", "clickable", "longClickable", "scrollable", "enabled", "focusable",
+              "focused", "selected", "covered"]
+
+
+def _str_to_bool(value):
+    """Convert string 'true'/'false' to boolean, or return original value if already boolean"""
+    if isinstance(value, str):
+        return value.lower() == "true"
+    return bool(value)
+
+
+def _selector_conditions(selector: u2.Selector) -> List[Tuple[str, str, str]]:
+    """
+    Translate the node conditions of a u2 Selector (without child/sibling relations and instance).
+
+    Returns:
+        List[Tuple[str, str, str]]: (attribute, operator, value) in the order of the xpath predicates.
+            The operator is one of "=", "contains" and "starts-with".
+    """
+    conditions = []
+
+    if "className" in selector:
+        conditions.append(("class", "=", f"{selector['className']}"))
+
+    if "text" in selector:
+        conditions.append(("text", "=", f"{selector['text']}"))
+    elif "textContains" in selector:
+        conditions.append(("text", "contains", f"{selector['textContains']}"))
+    elif "textStartsWith" in selector:
+        conditions.append(("text", "starts-with", f"{selector['textStartsWith']}"))
+    elif "textMatches" in selector:
+        raise NotImplementedError("'textMatches' syntax is not supported")
+
+    if "description" in selector:
+        conditions.append(("content-desc", "=", f"{selector['description']}"))
+    elif "descriptionContains" in selector:
+        conditions.append(("content-desc", "contains", f"{selector['descriptionContains']}"))
+    elif "descriptionStartsWith" in selector:
+        conditions.append(("content-desc", "starts-with", f"{selector['descriptionStartsWith']}"))
+    elif "descriptionMatches" in selector:
+        raise NotImplementedError("'descriptionMatches' syntax is not supported")
+
+    if "packageName" in selector:
+        conditions.append(("package", "=", f"{selector['packageName']}"))
+    elif "packageNameMatches" in selector:
+        raise NotImplementedError("'packageNameMatches' syntax is not supported")
+
+    if "resourceId" in selector:
+        conditions.append(("resource-id", "=", f"{selector['resourceId']}"))
+    elif "resourceIdMatches" in selector:
+        raise NotImplementedError("'resourceIdMatches' syntax is not supported")
+
+    for prop in BOOL_PROPS:
+        if prop in selector:
+            conditions.append((prop, "=", "true" if _str_to_bool(selector[prop]) else "false"))
+
+    if "index" in selector:
+        conditions.append(("index", "=", f"{selector['index']}"))
+
+    return conditions
+
+
+def _condition_to_xpath(condition: Tuple[str, str, str]) -> str:
+    attr, op, value = condition
+    if op == "=":
+        return f"[@{attr}='{value}']"
+    return f"[{op}(@{attr}, '{value}')]"
+
+
+def _check_condition(node: etree._Element, condition: Tuple[str, str, str]) -> bool:
+    """Evaluate a condition on a node the same way as its xpath predicate"""
+    attr, op, value = condition
+    if op == "=":
+        return node.get(attr) == value
+    # contains() and starts-with() on a missing attribute test against the empty string
+    attr_value = node.get(attr, "")
+    if op == "contains":
+        return value in attr_value
+    return attr_value.startswith(value)
+
+
+class _XPathCache:
+    """
+    Bounded LRU cache from u2 selectors to compiled xpath. It's shared by all the steps,
+    since the preconditions query the same selectors on every new hierarchy.
+    """
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache: "OrderedDict[Tuple, etree.XPath]" = OrderedDict()
+
+    @staticmethod
+    def selector_key(selector: u2.Selector) -> Tuple:
+        """Normalize the selector into a hashable key. (mask is derived from the keys)"""
+        def _freeze(value):
+            if isinstance(value, dict):
+                return tuple(
+                    (k, _freeze(v)) for k, v in sorted(value.items(), key=lambda kv: kv[0]) if k != "mask"
+                )
+            if isinstance(value, (list, tuple)):
+                return tuple(_freeze(v) for v in value)
+            # 1 == True, but they are different in the xpath
+            return (type(value).__name__, value)
+        return _freeze(selector)
+
+    def get(self, selector: u2.Selector, to_xpath: Callable[[u2.Selector], str]) -> etree.XPath:
+        try:
+            key = self.selector_key(selector)
+            hash(key)
+        except TypeError:
+            # unhashable selector values, don't cache it.
+            self.misses += 1
+            return etree.XPath(to_xpath(selector))
+
+        compiled = self._cache.get(key)
+        if compiled is not None:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return compiled
+
+        self.misses += 1
+        compiled = etree.XPath(to_xpath(selector))
+        self._cache[key] = compiled
+        if len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+        return compiled
+
+    def __len__(self):
+        return len(self._cache)
+
+
+XPATH_CACHE = _XPathCache()
+
+
 class StaticU2UiObject(u2.UiObject):
     def __init__(self, session, selector):
         self.session: U2StaticDevice = session
@@ -111,58 +253,7 @@ class StaticU2UiObject(u2.UiObject):
 
             xpath = ".//node" if is_initial else "node"
 
-            conditions = []
-
-            if "className" in selector:
-                conditions.insert(0, f"[@class='{selector['className']}']")
-
-            if "text" in selector:
-                conditions.append(f"[@text='{selector['text']}']")
-            elif "textContains" in selector:
-                conditions.append(f"[contains(@text, '{selector['textContains']}')]")
-            elif "textStartsWith" in selector:
-                conditions.append(f"[starts-with(@text, '{selector['textStartsWith']}')]")
-            elif "textMatches" in selector:
-                raise NotImplementedError("'textMatches' syntax is not supported")
-
-            if "description" in selector:
-                conditions.append(f"[@content-desc='{selector['description']}']")
-            elif "descriptionContains" in selector:
-                conditions.append(f"[contains(@content-desc, '{selector['descriptionContains']}')]")
-            elif "descriptionStartsWith" in selector:
-                conditions.append(f"[starts-with(@content-desc, '{selector['descriptionStartsWith']}')]")
-            elif "descriptionMatches" in selector:
-                raise NotImplementedError("'descriptionMatches' syntax is not supported")
-
-            if "packageName" in selector:
-                conditions.append(f"[@package='{selector['packageName']}']")
-            elif "packageNameMatches" in selector:
-                raise NotImplementedError("'packageNameMatches' syntax is not supported")
-
-            if "resourceId" in selector:
-                conditions.append(f"[@resource-id='{selector['resourceId']}']")
-            elif "resourceIdMatches" in selector:
-                raise NotImplementedError("'resourceIdMatches' syntax is not supported")
-
-            bool_props = ["checkable", "checked", "clickable", "longClickable", "scrollable", "enabled", "focusable",
-                          "focused", "selected", "covered"]
-
-            def str_to_bool(value):
-                """Convert string 'true'/'false' to boolean, or return original value if already boolean"""
-                if isinstance(value, str):
-                    return value.lower() == "true"
-                return bool(value)
-
-            for prop in bool_props:
-                if prop in selector:
-                    bool_value = str_to_bool(selector[prop])
-                    value = "true" if bool_value else "false"
-                    conditions.append(f"[@{prop}='{value}']")
-
-            if "index" in selector:
-                conditions.append(f"[@index='{selector['index']}']")
-
-            xpath += "".join(conditions)
+            xpath += "".join(_condition_to_xpath(c) for c in _selector_conditions(selector))
 
             if "childOrSibling" in selector and selector["childOrSibling"]:
                 for i, relation in enumerate(selector["childOrSibling"]):
@@ -186,17 +277,25 @@ class StaticU2UiObject(u2.UiObject):
             return "//error"
 
 
+    def _match(self) -> List[etree._Element]:
+        """
+        Get the nodes matched by the selector. Answered from the match table of the hierarchy
+        when possible, otherwise by evaluating the xpath on the hierarchy.
+        """
+        matched_widgets = self.session.matcher.match(self.selector)
+        if matched_widgets is None:
+            self.session.ensure_covered()
+            xpath = XPATH_CACHE.get(self.selector, self.selector_to_xpath)
+            matched_widgets = xpath(self.session.xml)
+        return matched_widgets
+
     @property
     def exists(self):
         set_covered_to_deepest_node(self.selector)
-        xpath = self.selector_to_xpath(self.selector)
-        matched_widgets = self.session.xml.xpath(xpath)
-        return bool(matched_widgets)
+        return bool(self._match())
 
     def __len__(self):
-        xpath = self.selector_to_xpath(self.selector)
-        matched_widgets = self.session.xml.xpath(xpath)
-        return len(matched_widgets)
+        return len(self._match())
     
     def child(self, **kwargs):
         return StaticU2UiObject(self.session, self.selector.clone().child(**kwargs))
@@ -205,6 +304,8 @@ class StaticU2UiObject(u2.UiObject):
         return StaticU2UiObject(self.session, self.selector.clone().sibling(**kwargs))
 
     def __getattr__(self, attr):
+        # not answered from the static hierarchy
+        self.session.live_accessed = True
         return getattr(super(), attr)
 
 """
@@ -322,11 +423,15 @@ class StaticXpathUiObject(u2.xpath.XPathSelector):
             raise AttributeError("Invalid attr", key)
         if not hasattr(u2.xpath.XMLElement, key):
             raise AttributeError("Invalid attr", key)
+        # not answered from the static hierarchy
+        self.session._d.live_accessed = True
         return getattr(super(), key)
 
+BOUNDS_PATTERN = re.compile(r"\[(-?\d+),(-?\d+)\]\[(-?\d+),(-?\d+)\]")
+
+
 def _get_bounds(raw_bounds):
-    pattern = re.compile(r"\[(-?\d+),(-?\d+)\]\[(-?\d+),(-?\d+)\]")
-    m = re.match(pattern, raw_bounds)
+    m = BOUNDS_PATTERN.match(raw_bounds)
     try:
         bounds = [int(m.group(1)), int(m.group(2)), int(m.group(3)), int(m.group(4))]
     except Exception as e:
@@ -338,19 +443,61 @@ def _get_bounds(raw_bounds):
 
 
 class _HindenWidgetFilter:
-    def __init__(self, root: etree._Element):
+    """
+    Mark the widgets covered by a clickable widget drawn after them with covered="true".
+
+    backend:
+        "rtree": sweep in drawing order with a rtree of the widget centers.
+        "numpy": parse all the bounds in one pass and test the containment in batched array operations.
+    """
+    # clickable widgets tested per batch in the numpy backend (bounds the (batch x nodes) mask)
+    NUMPY_BATCH_SIZE = 256
+
+    def __init__(
+        self, root: etree._Element, backend: Literal["rtree", "numpy"] = "rtree",
+        lazy: bool = False, previous: "_HindenWidgetFilter" = None
+    ):
         # self.global_drawing_order = 0
+        self._root = root
+        self._backend = backend
         self._nodes = []
-
-        self.idx = rtree.index.Index()
+        self.full_pass_done = False
+
+        # lazy mode: drawing-order positions of the nodes and the clickable widgets ([node, bounds])
+        self._sweep: List[etree._Element] = None
+        self._positions: Dict[etree._Element, int] = None
+        self._clickable_positions: List[int] = None
+        self._clickables: List[list] = None
+
+        # lazy mode: the filter of a previous hierarchy to reuse covered results from
+        self.reused_count = 0
+        self._previous = None
+        if previous is not None:
+            # keep a single previous filter alive, the one having the drawing order computed.
+            self._previous = previous if previous._sweep is not None else previous._previous
+            previous._previous = None
+
+        if not lazy:
+            self.ensure_full_pass()
+
+    def ensure_full_pass(self):
+        """Set the covered attribute on all the nodes. (Only runs once)"""
+        if self.full_pass_done:
+            return
+        self.full_pass_done = True
         try:
-            self.set_covered_attr(root)
+            with span("covered full pass", backend=self._backend):
+                if self._backend == "numpy":
+                    self.set_covered_attr_numpy(self._root)
+                else:
+                    self.idx = rtree.index.Index()
+                    self.set_covered_attr(self._root)
         except Exception as e:
             import traceback, uuid
             traceback.print_exc()
             logger.error(f"Error in setting covered widgets")
             with open(f"kea2_error_tree_{uuid.uuid4().hex}.xml", "wb") as f:
-                xml_bytes = etree.tostring(root, pretty_print=True, encoding="utf-8", xml_declaration=True)
+                xml_bytes = etree.tostring(self._root, pretty_print=True, encoding="utf-8", xml_declaration=True)
                 f.write(xml_bytes)
 
         # xml_bytes = etree.tostring(root, pretty_print=True, encoding="utf-8", xml_declaration=True)
@@ -358,6 +505,93 @@ class _HindenWidgetFilter:
         #     f.write(xml_bytes)
         # xml_bytes
 
+    def is_covered(self, node: etree._Element) -> Optional[str]:
+        """
+        Get the covered attribute of a node. Computed on demand for this node only,
+        and cached on the node for the rest of the step.
+        """
+        covered = node.get("covered")
+        if covered is None and not self.full_pass_done:
+            try:
+                if self._positions is None:
+                    self._init_sweep()
+                    # may be reused from the previous hierarchy
+                    covered = node.get("covered")
+                if covered is None:
+                    covered = self._compute_covered(node)
+                    node.set("covered", covered)
+            except Exception:
+                # let the full pass handle (and report) the broken hierarchy
+                self.ensure_full_pass()
+                covered = node.get("covered")
+        return covered
+
+    def _init_sweep(self):
+        with span("covered sweep"):
+            self._build_sweep()
+
+    def _build_sweep(self):
+        self._sweep: List[etree._Element] = list()
+        self._geometry: List[Tuple[Optional[str], bool]] = list()
+        self._positions = dict()
+        self._clickable_positions = list()
+        self._clickables = list()
+        for pos, e in enumerate(self._iter_by_drawing_order(self._root)):
+            raw_bounds, clickable = e.get("bounds"), e.get("clickable", "false") == "true"
+            self._sweep.append(e)
+            self._geometry.append((raw_bounds, clickable))
+            self._positions[e] = pos
+            if clickable and raw_bounds is not None:
+                self._clickable_positions.append(pos)
+                # bounds are parsed on demand
+                self._clickables.append([e, None])
+
+        if self._previous is not None:
+            self.reused_count = self._reuse(self._previous)
+            self._previous = None
+
+    def _reuse(self, previous: "_HindenWidgetFilter") -> int:
+        """
+        Copy the covered results of the previous hierarchy for the widgets in the unchanged
+        suffix of the drawing order. A widget is only covered by the clickable widgets drawn
+        after it, so the same suffix of (bounds, clickable) gives the same results.
+
+        Returns:
+            int: the count of reused results
+        """
+        suffix = 0
+        for cur, prev in zip(reversed(self._geometry), reversed(previous._geometry)):
+            if cur != prev:
+                break
+            suffix += 1
+        if suffix == 0:
+            return 0
+
+        reused = 0
+        for cur_node, prev_node in zip(self._sweep[-suffix:], previous._sweep[-suffix:]):
+            covered = prev_node.get("covered")
+            if covered is not None:
+                cur_node.set("covered", covered)
+                reused += 1
+        return reused
+
+    def _compute_covered(self, node: etree._Element) -> str:
+        _raw_bounds = node.get("bounds")
+        if _raw_bounds is None or node not in self._positions:
+            return "false"
+        bounds = _get_bounds(_raw_bounds)
+        center_x, center_y = (bounds[0] + bounds[2]) / 2, (bounds[1] + bounds[3]) / 2
+
+        # only the clickable widgets drawn after the node cover it
+        start = bisect.bisect_right(self._clickable_positions, self._positions[node])
+        for clickable in self._clickables[start:]:
+            if clickable[1] is None:
+                clickable[1] = _get_bounds(clickable[0].get("bounds"))
+            b = clickable[1]
+            if b[0] <= center_x <= b[2] and b[1] <= center_y <= b[3]:
+                return "true"
+        return "false"
+
     def _iter_by_drawing_order(self, ele: etree._Element):
         """
         iter by drawing order (DFS)
@@ -409,11 +643,236 @@ class _HindenWidgetFilter:
             )
             self._nodes.append(e)
 
+    def set_covered_attr_numpy(self, root: etree._Element):
+        """
+        Same result as set_covered_attr: a widget is covered if the bounds of a clickable
+        widget drawn after it contain its center.
+        """
+        self._nodes: List[etree._Element] = list()
+        bounds, clickable = list(), list()
+        for e in self._iter_by_drawing_order(root):
+            e.set("covered", "false")
+            _raw_bounds = e.get("bounds")
+            if _raw_bounds is None:
+                continue
+            bounds.append(_get_bounds(_raw_bounds))
+            clickable.append(e.get("clickable", "false") == "true")
+            self._nodes.append(e)
+
+        if not self._nodes:
+            return
+
+        bounds = np.array(bounds, dtype=np.int64)
+        center_x = (bounds[:, 0] + bounds[:, 2]) / 2
+        center_y = (bounds[:, 1] + bounds[:, 3]) / 2
+        order = np.arange(len(self._nodes))
+        covered = np.zeros(len(self._nodes), dtype=bool)
+
+        clickable_ids = np.flatnonzero(clickable)
+        for start in range(0, len(clickable_ids), self.NUMPY_BATCH_SIZE):
+            ids = clickable_ids[start:start + self.NUMPY_BATCH_SIZE]
+            b = bounds[ids]
+            contained = (
+                (center_x >= b[:, 0:1]) & (center_x <= b[:, 2:3]) &
+                (center_y >= b[:, 1:2]) & (center_y <= b[:, 3:4]) &
+                # only the widgets drawn before the clickable one
+                (order < ids[:, None])
+            )
+            covered |= contained.any(axis=0)
+
+        for covered_id in np.flatnonzero(covered):
+            self._nodes[covered_id].set("covered", "true")
+
+
+Condition = Tuple[str, str, str]
+
+
+class _SelectorPatterns:
+    """
+    The node conditions of all the selectors queried so far, compiled into one dispatch table.
+    It's shared by all the hierarchies, since the preconditions query the same selectors on
+    every step.
+
+    A pattern is anchored on one of its equality conditions (preferably an attribute in
+    ANCHOR_ATTRS): a node is only checked against the patterns anchored on its own attribute
+    values. The patterns without equality conditions are checked on every node.
+    """
+    ANCHOR_ATTRS = ("text", "resource-id", "content-desc", "class", "package")
+
+    def __init__(self):
+        self.ids: Dict[Tuple[Condition, ...], int] = dict()
+        # pattern id -> (anchor condition or None, the other conditions with covered last)
+        self.patterns: List[Tuple[Optional[Condition], List[Condition]]] = list()
+
+    def register(self, conditions: List[Condition]) -> int:
+        key = tuple(conditions)
+        pid = self.ids.get(key)
+        if pid is None:
+            pid = self.ids[key] = len(self.patterns)
+            equalities = [c for c in conditions if c[1] == "=" and c[0] != "covered"]
+            equalities.sort(key=lambda c: c[0] not in self.ANCHOR_ATTRS)
+            anchor = equalities[0] if equalities else None
+            rest = [c for c in conditions if c is not anchor]
+            # covered is the expensive one, only check it on the nodes passing the others.
+            rest.sort(key=lambda c: c[0] == "covered")
+            self.patterns.append((anchor, rest))
+        return pid
+
+    def dispatch(self, start: int) -> Tuple[Dict[str, Dict[str, List[int]]], List[int]]:
+        """
+        The dispatch table (attribute -> value -> pattern ids) and the unanchored patterns,
+        of the patterns registered since start.
+        """
+        anchored: Dict[str, Dict[str, List[int]]] = dict()
+        unanchored: List[int] = list()
+        for pid in range(start, len(self.patterns)):
+            anchor = self.patterns[pid][0]
+            if anchor is None:
+                unanchored.append(pid)
+            else:
+                anchored.setdefault(anchor[0], dict()).setdefault(anchor[2], []).append(pid)
+        return anchored, unanchored
+
+
+class _SelectorMatcher:
+    """
+    Match all the known selectors on one hierarchy in a single walk of the tree.
+
+    The walk fills a match table (pattern id -> matched nodes in document order) for all the
+    registered patterns. The child and sibling relations and the instance of a selector are
+    then answered from the table. A selector seen for the first time is registered and
+    matched in one more walk, only for the new patterns.
+    """
+
+    def __init__(self, root: etree._Element, patterns: _SelectorPatterns, covered_filter: "_HindenWidgetFilter" = None):
+        self.root = root
+        self._patterns = patterns
+        self._covered_filter = covered_filter
+        self._table: List[List[etree._Element]] = list()
+        self._results: Dict[Tuple, List[etree._Element]] = dict()
+        self.walks = 0
+
+    def _check(self, node: etree._Element, condition: Condition) -> bool:
+        if condition[0] == "covered" and self._covered_filter is not None:
+            return self._covered_filter.is_covered(node) == condition[2]
+        return _check_condition(node, condition)
+
+    def _walk(self):
+        start = len(self._table)
+        anchored, unanchored = self._patterns.dispatch(start)
+        self._table.extend([] for _ in range(start, len(self._patterns.patterns)))
+        patterns, table, check = self._patterns.patterns, self._table, self._check
+        self.walks += 1
+        # .//node never matches the root itself
+        for node in self.root.iterdescendants("node"):
+            for attr, by_value in anchored.items():
+                pids = by_value.get(node.get(attr))
+                if pids:
+                    for pid in pids:
+                        if all(check(node, c) for c in patterns[pid][1]):
+                            table[pid].append(node)
+            for pid in unanchored:
+                if all(check(node, c) for c in patterns[pid][1]):
+                    table[pid].append(node)
+
+    def _compile(self, selector: u2.Selector) -> Optional[Tuple[int, List[Tuple[str, int]], Optional[int]]]:
+        """
+        Compile the selector into (pattern id, [(relation, pattern id)], instance).
+        None if it can't be answered by the matcher.
+        """
+        selectors = [selector] + list(selector.get("childOrSiblingSelector") or [])
+        relations = list(selector.get("childOrSibling") or [])
+        if len(relations) != len(selectors) - 1 or any(r not in ("child", "sibling") for r in relations):
+            return None
+        instance = selector.get("instance", None)
+        if instance is not None and not (isinstance(instance, int) and instance >= 0):
+            return None
+
+        pids = []
+        for idx, sub_selector in enumerate(selectors):
+            # the nested relations and instances are not valid in the generated xpath
+            if idx > 0 and (sub_selector.get("childOrSibling") or "instance" in sub_selector):
+                return None
+            try:
+                conditions = _selector_conditions(sub_selector)
+            except NotImplementedError:
+                return None
+            # quotes break the generated xpath, keep the xpath behaviour for them.
+            if any("'" in value for _, _, value in conditions):
+                return None
+            pids.append(self._patterns.register(conditions))
+        return pids[0], list(zip(relations, pids[1:])), instance
+
+    def match(self, selector: u2.Selector) -> Optional[List[etree._Element]]:
+        """
+        Get the nodes matched by the selector in document order.
+
+        Returns:
+            The matched nodes, or None if the selector can't be answered by the matcher.
+        """
+        try:
+            key = _XPathCache.selector_key(selector)
+            hash(key)
+        except TypeError:
+            key = None
+        if key is not None and key in self._results:
+            return self._results[key]
+
+        compiled = self._compile(selector)
+        if compiled is None:
+            return None
+        head, relations, instance = compiled
+        if len(self._table) < len(self._patterns.patterns):
+            self._walk()
+
+        matched = self._table[head]
+        for relation, pid in relations:
+            if relation == "child":
+                # cur//node[...]: the descendants of the matched nodes
+                ancestors = set(matched)
+                matched = [n for n in self._table[pid] if any(a in ancestors for a in n.iterancestors())]
+            else:
+                # (cur/following-sibling::node[...] | cur/preceding-sibling::node[...])
+                parents: Dict[etree._Element, int] = dict()
+                for n in matched:
+                    parent = n.getparent()
+                    parents[parent] = parents.get(parent, 0) + 1
+                current = set(matched)
+                matched = [
+                    n for n in self._table[pid]
+                    if parents.get(n.getparent(), 0) - (n in current) > 0
+                ]
+        if instance is not None:
+            matched = matched[instance:instance + 1]
+
+        if key is not None:
+            self._results[key] = matched
+        return matched
+
 
 class U2StaticDevice(u2.Device):
     def __init__(self, script_driver=None):
         self.xml: etree._Element = None
         self._script_driver = script_driver
+        self._matcher: _SelectorMatcher = None
+        self.covered_filter: _HindenWidgetFilter = None
+        self._page_source: u2.xpath.PageSource = None
+        self._page_source_root: etree._Element = None
+        # whether the device was accessed through the script driver (not only the static hierarchy)
+        self.live_accessed = False
+        # selectors queried by the preconditions so far, matched in one pass for every hierarchy
+        self._patterns = _SelectorPatterns()
+
+    @property
+    def matcher(self) -> _SelectorMatcher:
+        if self._matcher is None or self._matcher.root is not self.xml:
+            self._matcher = _SelectorMatcher(self.xml, self._patterns, self.covered_filter)
+        return self._matcher
+
+    def ensure_covered(self):
+        """Compute covered for the whole hierarchy, before it's queried by xpath."""
+        if self.covered_filter is not None:
+            self.covered_filter.ensure_full_pass()
 
     def __call__(self, **kwargs):
         ui = StaticU2UiObject(session=self, selector=u2.Selector(**kwargs))
@@ -421,13 +880,28 @@ class U2StaticDevice(u2.Device):
             ui.jsonrpc = self._script_driver.jsonrpc
         return ui
 
+    @property
+    def page_source(self) -> u2.xpath.PageSource:
+        """
+        The PageSource of the current hierarchy. It's serialized and parsed once per hierarchy
+        and shared by all the xpath selectors evaluated on it.
+        """
+        if self._page_source is None or self._page_source_root is not self.xml:
+            self.ensure_covered()
+            xml_raw = etree.tostring(self.xml, encoding='unicode')
+            self._page_source = u2.xpath.PageSource.parse(xml_raw)
+            self._page_source_root = self.xml
+        return self._page_source
+
     @property
     def xpath(self) -> u2.xpath.XPathEntry:
         def get_page_source(self):
             # print("[Debug] Using static get_page_source method")
-            xml_raw = etree.tostring(self._d.xml, encoding='unicode')
-            return u2.xpath.PageSource.parse(xml_raw)
+            return self._d.page_source
+        # _XPathEntry only checks wait_timeout from the proxied script driver
+        live_accessed = self.live_accessed
         xpathEntry = _XPathEntry(self)
+        self.live_accessed = live_accessed
         xpathEntry.get_page_source = types.MethodType(
             get_page_source, xpathEntry
         )
@@ -436,6 +910,7 @@ class U2StaticDevice(u2.Device):
     def __getattr__(self, attr):
         """Proxy other methods to script_driver"""
         logger.debug(f"{attr} not exists in static checker, proxy to script_driver.")
+        self.live_accessed = True
         return getattr(self._script_driver, attr)
 
 class _XPathEntry(u2.xpath.XPathEntry):
@@ -465,19 +940,66 @@ class U2StaticChecker(AbstractStaticChecker):
         ...
     ```
     """
-    def __init__(self):
-        self.d = U2StaticDevice(U2ScriptDriver().getInstance()) 
+    covered_backend: Literal["rtree", "numpy"] = "rtree"
+    # compute covered on demand instead of a full pass on every hierarchy
+    lazy_covered: bool = True
+    # reuse the work done on the hierarchy of the previous step
+    incremental: bool = True
+
+    # statistics of the hierarchies
+    hierarchy_count: int = 0
+    identical_hierarchy_count: int = 0
+    full_pass_avoided: int = 0
+    reused_covered_count: int = 0
+
+    def __init__(self, detached: bool = False):
+        # a detached checker answers from the static hierarchy only (see U2Driver.detachStaticChecker)
+        self.d = U2StaticDevice(None if detached else U2ScriptDriver().getInstance())
 
     def setHierarchy(self, hierarchy: str):
         if hierarchy is None:
             return
+        last_raw, last_root = getattr(self, "_last_hierarchy", (None, None))
+        if (
+            self.incremental and isinstance(hierarchy, str)
+            and self.d.xml is last_root and hierarchy == last_raw
+        ):
+            # Same dump as the previous step. Keep the parsed tree, with its covered results,
+            # selector index and page source.
+            self.identical_hierarchy_count += 1
+            return
+        self._collect_statistics()
         if isinstance(hierarchy, str):
-            self.d.xml = etree.fromstring(hierarchy.encode("utf-8"))
+            with span("parse hierarchy"):
+                self.d.xml = etree.fromstring(hierarchy.encode("utf-8"))
         elif isinstance(hierarchy, etree._Element):
             self.d.xml = hierarchy
         elif isinstance(hierarchy, etree._ElementTree):
             self.d.xml = hierarchy.getroot()
-        _HindenWidgetFilter(self.d.xml)
+        self._last_hierarchy = (hierarchy if isinstance(hierarchy, str) else None, self.d.xml)
+        self.hierarchy_count += 1
+        self.d.covered_filter = _HindenWidgetFilter(
+            self.d.xml, backend=self.covered_backend, lazy=self.lazy_covered,
+            previous=self.d.covered_filter if self.incremental and self.lazy_covered else None,
+        )
+
+    def _collect_statistics(self):
+        covered_filter = self.d.covered_filter
+        if covered_filter is None or covered_filter is getattr(self, "_counted_filter", None):
+            return
+        # only count a hierarchy once
+        self._counted_filter = covered_filter
+        if not covered_filter.full_pass_done:
+            self.full_pass_avoided += 1
+        self.reused_covered_count += covered_filter.reused_count
+
+    def logStatistics(self):
+        self._collect_statistics()
+        logger.info(
+            f"Covered widgets full pass avoided in {self.full_pass_avoided}/{self.hierarchy_count} hierarchies, "
+            f"{self.reused_covered_count} covered results reused from the previous hierarchies. "
+            f"{self.identical_hierarchy_count} identical hierarchies reused."
+        )
 
     def getInstance(self, hierarchy: str=None):
         self.setHierarchy(hierarchy)
@@ -498,6 +1020,13 @@ class U2Driver(AbstractDriver):
         if kwarg.get("transport_id"):
             U2ScriptDriver.setTransportId(kwarg["transport_id"])
 
+    @classmethod
+    def setStaticCheckerOptions(cls, covered_backend: Literal["rtree", "numpy"] = "rtree", **kwargs):
+        if covered_backend == "numpy" and np is None:
+            logger.warning("numpy not installed (pip install kea2-python[numpy]). Fallback to the rtree covered backend.")
+            covered_backend = "rtree"
+        U2StaticChecker.covered_backend = covered_backend
+
     @classmethod
     def getScriptDriver(self):
         if self.scriptDriver is None:
@@ -510,8 +1039,20 @@ class U2Driver(AbstractDriver):
             self.staticChecker = U2StaticChecker()
         return self.staticChecker.getInstance(hierarchy)
 
+    @classmethod
+    def detachStaticChecker(cls):
+        # the device accesses in the preconditions are marked live_accessed and fail
+        cls.staticChecker = U2StaticChecker(detached=True)
+        return True
+
     @classmethod
     def tearDown(self):
+        logger.debug(
+            f"Selector xpath cache: {XPATH_CACHE.hits} hits, {XPATH_CACHE.misses} misses, "
+            f"{len(XPATH_CACHE)} cached."
+        )
+        if self.staticChecker:
+            self.staticChecker.logStatistics()
         if self.scriptDriver:
             self.scriptDriver.tearDown()
 
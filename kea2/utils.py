@@ -1,8 +1,9 @@
+import hashlib
 import logging
 import os
 from pathlib import Path
 import traceback
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Union
 
 import time
 from functools import wraps
@@ -64,6 +65,14 @@ def getProjectRoot():
     return cur_dir
 
 
+def getHierarchyFingerprint(hierarchy: Union[str, bytes]) -> str:
+    """Get the fingerprint of a hierarchy dump. The same dump gives the same fingerprint.
+    """
+    if isinstance(hierarchy, str):
+        hierarchy = hierarchy.encode("utf-8")
+    return hashlib.sha1(hierarchy).hexdigest()
+
+
 def timer(log_info: str=None):
     """ ### Decorator to measure the execution time of a function.
 
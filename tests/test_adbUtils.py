@@ -0,0 +1,66 @@
+import hashlib
+import shlex
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from types import SimpleNamespace
+
+from kea2.adbUtils import ADBDevice, _md5sum
+
+
+class FakeDevice:
+    """
+    Fake device keeping the pushed files in memory.
+    """
+    md5sum = ADBDevice.md5sum
+    push_files = ADBDevice.push_files
+
+    def __init__(self):
+        self.files = dict()
+        self.shell_calls = 0
+        self.lock = threading.Lock()
+        self.sync = SimpleNamespace(push=self._push)
+
+    def _push(self, local, remote):
+        with self.lock:
+            self.files[remote] = Path(local).read_bytes()
+
+    def shell(self, cmd):
+        self.shell_calls += 1
+        lines = []
+        for path in shlex.split(cmd)[1:-1]:
+            if path in self.files:
+                lines.append(f"{hashlib.md5(self.files[path]).hexdigest()}  {path}")
+        return "\n".join(lines)
+
+
+class TestPushFiles(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.files = []
+        for i in range(3):
+            local = Path(tmp.name) / f"file{i}.jar"
+            local.write_bytes(f"content {i}".encode())
+            self.files.append((local, f"/sdcard/file {i}.jar"))
+
+    def test_skip_identical_files(self):
+        dev = FakeDevice()
+        self.assertEqual(len(dev.push_files(self.files)), 3)
+        self.assertEqual(dev.push_files(self.files), [])
+
+        self.files[1][0].write_bytes(b"changed")
+        self.assertEqual(dev.push_files(self.files), ["/sdcard/file 1.jar"])
+        self.assertEqual(dev.files["/sdcard/file 1.jar"], b"changed")
+        # one md5sum call per push
+        self.assertEqual(dev.shell_calls, 3)
+
+    def test_md5sum(self):
+        local = self.files[0][0]
+        self.assertEqual(_md5sum(local), hashlib.md5(local.read_bytes()).hexdigest())
+
+
+if __name__ == "__main__":
+    unittest.main()
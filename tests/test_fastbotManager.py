@@ -0,0 +1,194 @@
+import json
+import socket
+import threading
+import unittest
+from types import SimpleNamespace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from kea2.fastbotManager import BlockPayloadEncoder, FastbotManager, FastbotSession, LatencyHistogram
+
+
+class BlockPayloadReplay:
+    """
+    Stand-in for the server side of the block delta protocol.
+    Rebuilds the full block lists from the received payloads.
+    """
+    def __init__(self):
+        self.blocks = dict()
+
+    def receive(self, payload):
+        version = payload["block_version"]
+        if "block_widgets" in payload:
+            self.blocks[version] = (set(payload["block_widgets"]), set(payload["block_trees"]))
+        if version not in self.blocks:
+            raise KeyError(f"Unknown block version: {version}")
+        return self.blocks[version]
+
+
+def step_info(widgets, trees=(), steps_count=0):
+    return {"block_widgets": list(widgets), "block_trees": list(trees), "steps_count": steps_count}
+
+
+class TestBlockPayloadEncoder(unittest.TestCase):
+
+    def test_replay(self):
+        encoder = BlockPayloadEncoder()
+        server = BlockPayloadReplay()
+        steps = [
+            step_info(["//a", "//b"]),
+            step_info(["//b", "//a"]),
+            step_info(["//a"], ["//t"]),
+            step_info(["//a"], ["//t"]),
+            step_info([]),
+        ]
+        sent_lists = 0
+        for i, info in enumerate(steps):
+            info["steps_count"] = i
+            payload = encoder.encode(info)
+            self.assertEqual(payload["steps_count"], i)
+            sent_lists += "block_widgets" in payload
+            received = server.receive(payload)
+            encoder.ack()
+            self.assertEqual(received, (set(info["block_widgets"]), set(info["block_trees"])))
+        self.assertEqual(sent_lists, 3)
+
+    def test_resend_when_not_acked(self):
+        encoder = BlockPayloadEncoder()
+        server = BlockPayloadReplay()
+        # the first request is lost
+        encoder.encode(step_info(["//a"]))
+        payload = encoder.encode(step_info(["//a"]))
+        self.assertIn("block_widgets", payload)
+        self.assertEqual(server.receive(payload), ({"//a"}, set()))
+        encoder.ack()
+        payload = encoder.encode(step_info(["//a"]))
+        self.assertNotIn("block_widgets", payload)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Stand-in for the fastbot server. Echoes the posted json.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        content = json.dumps({"result": json.loads(body)}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(content)))
+        if self.path == "/close":
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ForwardedDevice:
+    """
+    Forward the connections to the local stand-in server, as adb forwards them to the device.
+    """
+    def __init__(self, port):
+        self.port = port
+        self.connections = []
+
+    def create_connection(self, network, port):
+        sock = socket.create_connection(("127.0.0.1", self.port))
+        self.connections.append(sock)
+        return sock
+
+
+class TestFastbotSession(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.dev = ForwardedDevice(self.server.server_address[1])
+        self.session = FastbotSession(self.dev)
+
+    def tearDown(self):
+        self.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keep_alive(self):
+        for i in range(5):
+            r = self.session.request("POST", "/stepMonkey", {"steps_count": i})
+            self.assertEqual(r.json()["result"], {"steps_count": i})
+        self.assertEqual(self.session.connect_count, 1)
+        self.assertEqual(self.session.latency["/stepMonkey"].count, 5)
+
+    def test_reconnect(self):
+        self.session.request("POST", "/close", {"a": 1})
+        self.session.request("POST", "/stepMonkey", {"a": 2})
+        self.assertEqual(self.session.connect_count, 2)
+        # the server drops the idle connection
+        self.dev.connections[-1].shutdown(socket.SHUT_RDWR)
+        r = self.session.request("POST", "/stepMonkey", {"a": 3})
+        self.assertEqual(r.json()["result"], {"a": 3})
+        self.assertEqual(self.session.connect_count, 3)
+
+
+def make_init_handler(*confirmed):
+    class InitHandler(StandInHandler):
+        def do_POST(self):
+            if self.path != "/init":
+                return super().do_POST()
+            self.rfile.read(int(self.headers["Content-Length"]))
+            text = "".join(["outputDir:/sdcard/output"] + [f"\n{name}:true" for name in confirmed])
+            content = text.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+    return InitHandler
+
+
+class TestNegotiation(unittest.TestCase):
+
+    def init_fastbot(self, *confirmed):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), make_init_handler(*confirmed))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        fb = FastbotManager.__new__(FastbotManager)
+        fb.session = FastbotSession(ForwardedDevice(server.server_address[1]))
+        fb._blockEncoder = None
+        self.addCleanup(fb.session.close)
+        options = SimpleNamespace(
+            take_screenshots=False, device_output_root="/sdcard", block_delta=True, batch_steps=4
+        )
+        fb.init(options=options, stamp="stamp")
+        return fb
+
+    def test_not_confirmed(self):
+        fb = self.init_fastbot()
+        self.assertFalse(fb.batch_supported)
+        for i in range(2):
+            payload = fb.stepMonkey(step_info(["//a"], steps_count=i))
+            self.assertEqual(payload["block_widgets"], ["//a"])
+            self.assertNotIn("block_version", payload)
+
+    def test_confirmed(self):
+        fb = self.init_fastbot("blockDelta", "batchSteps")
+        self.assertTrue(fb.batch_supported)
+        fb.stepMonkey(step_info(["//a"]))
+        payload = fb.stepMonkey(step_info(["//a"], steps_count=1))
+        self.assertNotIn("block_widgets", payload)
+        self.assertEqual(payload["block_version"], 1)
+
+
+class TestLatencyHistogram(unittest.TestCase):
+
+    def test_percentile(self):
+        histogram = LatencyHistogram()
+        for cost in (0.5, 3, 3, 4, 150):
+            histogram.record(cost)
+        self.assertEqual(histogram.count, 5)
+        self.assertEqual(histogram.percentile(50), 5)
+        self.assertEqual(histogram.percentile(100), 150)
+
+
+if __name__ == "__main__":
+    unittest.main()
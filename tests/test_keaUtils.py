@@ -0,0 +1,452 @@
+import json
+import tempfile
+import threading
+import time
+import unittest
+from collections import OrderedDict
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from unittest import mock
+
+from kea2.fastbotManager import FastbotManager, FastbotSession
+from kea2.keaUtils import KeaTestRunner, PreconditionCache, PrecondStatistics, JsonResult, max_tries, precondition, prob
+from kea2.precondPool import PrecondPool, forkAvailable
+from kea2.scheduler import makeScheduler
+from test_fastbotManager import ForwardedDevice
+from test_u2Selector import XML_PATH, U2StaticCheckerForTest
+
+
+class FakeDriver:
+    checker = U2StaticCheckerForTest()
+    parsed = 0
+
+    @classmethod
+    def getStaticChecker(cls, hierarchy=None):
+        if hierarchy is not None:
+            cls.parsed += 1
+        return cls.checker.getInstance(hierarchy)
+
+    @classmethod
+    def detachStaticChecker(cls):
+        cls.checker.d._script_driver = None
+        return True
+
+
+class Properties(unittest.TestCase):
+
+    @precondition(lambda self: self.d(text="添加朋友").exists)
+    def test_static(self):
+        ...
+
+    @precondition(lambda self: self.d(text="不存在的文本").exists)
+    def test_unsatisfied(self):
+        ...
+
+    @precondition(lambda self: self.d.device_info is None or True)
+    def test_live(self):
+        ...
+
+
+class KeaTestRunnerForTest(KeaTestRunner):
+    def __del__(self):
+        pass
+
+
+def make_runner(cache_size, properties=Properties, **options):
+    runner = KeaTestRunnerForTest()
+    runner.options = SimpleNamespace(**{"driverName": "d", "Driver": FakeDriver, **options})
+    runner.allProperties = dict()
+    runner.collectAllProperties(unittest.defaultTestLoader.loadTestsFromTestCase(properties))
+    JsonResult.setProperties(runner.allProperties)
+    runner._precondCache = PreconditionCache(cache_size) if cache_size else None
+    runner._scheduler = makeScheduler(getattr(runner.options, "scheduler", "random"))
+    return runner
+
+
+class TestPreconditionCache(unittest.TestCase):
+
+    def setUp(self):
+        self.raw = XML_PATH.read_text(encoding="utf-8")
+        self.result = SimpleNamespace(getExcuted=lambda test: 0)
+        # proxy the "live" device calls to a fake script driver
+        FakeDriver.checker.d._script_driver = SimpleNamespace(device_info={}, jsonrpc=None)
+
+    def test_cache_hit_skips_static_preconds(self):
+        runner = make_runner(cache_size=4)
+        valid = runner.getValidProperties(self.raw, self.result)
+        self.assertEqual(set(valid), {"test_static", "test_live"})
+        self.assertEqual(runner._precondCache.uncacheable, {"test_live"})
+
+        parsed = FakeDriver.parsed
+        valid = runner.getValidProperties(self.raw, self.result)
+        self.assertEqual(set(valid), {"test_static", "test_live"})
+        self.assertEqual(runner._precondCache.hits, 1)
+        # test_live is evaluated again
+        self.assertEqual(FakeDriver.parsed, parsed + 1)
+
+    def test_lru_eviction(self):
+        cache = PreconditionCache(maxsize=2)
+        for fingerprint in ("a", "b", "a", "c"):
+            cache.update(fingerprint, {"p": True})
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), {"p": True})
+
+
+@unittest.skipUnless(forkAvailable(), "fork is not available")
+class TestPrecondPool(unittest.TestCase):
+
+    def setUp(self):
+        self.raw = XML_PATH.read_text(encoding="utf-8")
+        self.result = SimpleNamespace(getExcuted=lambda test: 0)
+        FakeDriver.checker.d._script_driver = SimpleNamespace(device_info={}, jsonrpc=None)
+
+    def test_same_as_serial(self):
+        serial = make_runner(cache_size=4)
+        expected = serial.getValidProperties(self.raw, self.result)
+
+        runner = make_runner(cache_size=4)
+        runner._precondPool = PrecondPool(2, FakeDriver, "d", runner.allProperties)
+        try:
+            self.assertTrue(runner._precondPool.available)
+            evaluated, undetermined = runner._precondPool.evaluate(self.raw, list(runner.allProperties))
+            # the live access is evaluated in the main process
+            self.assertEqual(evaluated, {"test_static": True, "test_unsatisfied": False})
+            self.assertEqual(undetermined, ["test_live"])
+
+            for _ in range(2):
+                valid = runner.getValidProperties(self.raw, self.result)
+                self.assertEqual(list(valid), list(expected))
+            self.assertEqual(runner._precondCache.uncacheable, {"test_live"})
+        finally:
+            runner._precondPool.close()
+
+
+CALLS = []
+
+
+def slow_precond(self):
+    CALLS.append("slow")
+    time.sleep(0.002)
+    return True
+
+
+def fast_precond(self):
+    CALLS.append("fast")
+    return False
+
+
+class OrderedProperties(unittest.TestCase):
+
+    @precondition(fast_precond)
+    @precondition(slow_precond)
+    def test_ordered(self):
+        ...
+
+    @max_tries(1)
+    @precondition(slow_precond)
+    def test_once(self):
+        ...
+
+
+class TestAdaptivePreconds(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.stats_file = Path(self.tmp.name) / "precond_stats.json"
+        self.runner = make_runner(cache_size=0, properties=OrderedProperties)
+        self.runner._precondStats = PrecondStatistics(self.stats_file)
+        self.executed = {"test_ordered": 0, "test_once": 0}
+        self.result = SimpleNamespace(getExcuted=lambda test: self.executed[test._testMethodName])
+        self.raw = XML_PATH.read_text(encoding="utf-8")
+        CALLS.clear()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_cheap_false_precond_first(self):
+        self.executed["test_once"] = 1
+        self.runner.getValidProperties(self.raw, self.result, verbose=False)
+        # declaration order the first time
+        self.assertEqual(CALLS, ["slow", "fast"])
+        CALLS.clear()
+        self.runner.getValidProperties(self.raw, self.result, verbose=False)
+        self.assertEqual(CALLS, ["fast"])
+
+        # the next run starts with the saved order
+        self.runner._precondStats.save()
+        CALLS.clear()
+        runner = make_runner(cache_size=0, properties=OrderedProperties)
+        runner._precondStats = PrecondStatistics(self.stats_file)
+        runner.getValidProperties(self.raw, self.result, verbose=False)
+        self.assertEqual(CALLS, ["fast"])
+
+    def test_retire_max_tries(self):
+        valid = self.runner.getValidProperties(self.raw, self.result, verbose=False)
+        self.assertEqual(set(valid), {"test_once"})
+        self.executed["test_once"] = 1
+        CALLS.clear()
+        valid = self.runner.getValidProperties(self.raw, self.result, verbose=False)
+        self.assertEqual(valid, {})
+        # the preconds of the retired property are not evaluated
+        self.assertEqual(CALLS, ["fast"])
+        self.assertEqual(self.runner._retired, {"test_once"})
+
+
+def block_dialog(d):
+    return [d(text="添加朋友")]
+
+
+def block_tree_missing(d):
+    return d(resourceId="not.exists:id/list")
+
+
+block_dialog.preconds = (lambda d: d(text="添加朋友").exists,)
+block_tree_missing.preconds = (lambda d: d(text="不存在的文本").exists,)
+
+
+class LiveDriverUsed(Exception):
+    pass
+
+
+class TestBlockWidgetCache(unittest.TestCase):
+
+    def setUp(self):
+        self.raw = XML_PATH.read_text(encoding="utf-8")
+        self.runner = make_runner(cache_size=0)
+        self.runner._block_funcs = {"widgets": [block_dialog], "trees": [block_tree_missing]}
+        self.runner._blockCache = OrderedDict()
+
+        def getScriptDriver():
+            raise LiveDriverUsed()
+        self.runner.options.Driver.getScriptDriver = getScriptDriver
+
+    def tearDown(self):
+        del FakeDriver.getScriptDriver
+
+    def test_block_preconds_on_static_hierarchy(self):
+        self.runner._lastHierarchy = self.raw
+        blocked = self.runner._getBlockedWidgets()
+        self.assertEqual(len(blocked["widgets"]), 1)
+        self.assertIn("添加朋友", blocked["widgets"][0])
+        self.assertEqual(blocked["trees"], [])
+
+        parsed = FakeDriver.parsed
+        self.assertIs(self.runner._getBlockedWidgets(), blocked)
+        self.assertEqual(FakeDriver.parsed, parsed)
+
+    def test_stale_hierarchy_uses_device(self):
+        self.runner._lastHierarchy = None
+        with self.assertRaises(LiveDriverUsed):
+            self.runner._getBlockedWidgets()
+
+
+class StaticProperties(unittest.TestCase):
+
+    @precondition(lambda self: self.d(text="添加朋友").exists)
+    def test_static(self):
+        ...
+
+
+class ProbStaticProperties(unittest.TestCase):
+
+    @prob(0.5)
+    @precondition(lambda self: self.d(text="添加朋友").exists)
+    def test_static(self):
+        ...
+
+
+class RunDriver(FakeDriver):
+    @classmethod
+    def getScriptDriver(cls):
+        return SimpleNamespace()
+
+
+class FakeFastbot:
+    """
+    Replay the hierarchies of the monkey events.
+    """
+    def __init__(self, hierarchies):
+        self.hierarchies = list(hierarchies)
+        self.steps = []
+
+    def stepMonkey(self, monkeyStepInfo):
+        self.steps.append(monkeyStepInfo["steps_count"])
+        return self.hierarchies[len(self.steps) - 1]
+
+    def logScript(self, execution_info):
+        pass
+
+
+class RecordingResult(unittest.TestResult):
+    def __init__(self):
+        super().__init__()
+        self.executed = []
+        self.satisfied = 0
+        self.lastExecutedInfo = None
+
+    def getExcuted(self, test):
+        return 0
+
+    def addPrecondSatisfied(self, test):
+        self.satisfied += 1
+
+    def addExcuted(self, test, stepsCount):
+        self.executed.append(stepsCount)
+
+    def printErrors(self): ...
+    def updateExectedInfo(self): ...
+    def flushResult(self): ...
+
+
+class TestRunSteps(unittest.TestCase):
+
+    def setUp(self):
+        satisfied = XML_PATH.read_text(encoding="utf-8")
+        unsatisfied = satisfied.replace("添加朋友", "添加")
+        self.hierarchies = [unsatisfied, satisfied, satisfied, unsatisfied]
+
+    def make_runner(self, pipeline, properties=StaticProperties):
+        runner = make_runner(
+            cache_size=0, properties=properties,
+            Driver=RunDriver, maxStep=4, profile_period=0, pipeline=pipeline, batch_steps=1,
+        )
+        runner._block_funcs = {"widgets": [], "trees": []}
+        runner._blockCache = OrderedDict()
+        return runner
+
+    def run_steps(self, pipeline, properties=StaticProperties):
+        runner = self.make_runner(pipeline, properties)
+        fb = FakeFastbot(self.hierarchies)
+        result = RecordingResult()
+        self.assertFalse(runner._runSteps(fb, result, resultSyncer=None))
+        return fb, result
+
+    def test_serial(self):
+        fb, result = self.run_steps(pipeline=False)
+        self.assertEqual(fb.steps, [1, 2, 3, 4])
+        self.assertEqual(result.executed, [2, 3])
+
+    def test_pipeline_rollback(self):
+        fb, result = self.run_steps(pipeline=True)
+        self.assertEqual(fb.steps, [1, 2, 3, 4])
+        # step 2 is rolled back as step 3 was in flight. The property is checked again on step 3.
+        self.assertEqual(result.executed, [3])
+        # the precond satisfied on step 2 is still counted, as in the serial mode
+        self.assertEqual(result.satisfied, 2)
+
+    def test_pipeline_rollback_prob(self):
+        # @prob(0.5) passes on step 2 (rolled back), it must not be drawn again on step 3
+        with mock.patch("kea2.keaUtils.random.random", side_effect=[0.4, 0.9, 0.9]) as draw:
+            fb, result = self.run_steps(pipeline=True, properties=ProbStaticProperties)
+        self.assertEqual(result.executed, [3])
+        self.assertEqual(draw.call_count, 1)
+
+    def test_pipeline_abort(self):
+        runner = self.make_runner(pipeline=True)
+        done = []
+
+        class SlowFastbot(FakeFastbot):
+            def stepMonkey(self, monkeyStepInfo):
+                xml_raw = super().stepMonkey(monkeyStepInfo)
+                if monkeyStepInfo["steps_count"] == 2:
+                    time.sleep(0.2)
+                done.append(monkeyStepInfo["steps_count"])
+                return xml_raw
+
+        with mock.patch.object(runner, "getValidProperties", side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                runner._runSteps(SlowFastbot(self.hierarchies), RecordingResult(), resultSyncer=None)
+        # the in-flight step is not left running
+        self.assertEqual(done, [1, 2])
+
+
+def make_monkey_handler(hierarchies, batches, steps):
+    """
+    Stand-in for the fastbot server. Replays the hierarchies of the monkey events.
+    """
+    events = iter(hierarchies)
+
+    class MonkeyHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            data = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            batch_size = data.get("batch_size", 1)
+            batches.append(batch_size)
+            steps.append(data["steps_count"])
+            performed = [next(events) for _ in range(batch_size)]
+            res = {"result": performed[-1], "hierarchies": performed[:-1]}
+            content = json.dumps(res).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            pass
+
+    return MonkeyHandler
+
+
+class TestBatchSteps(unittest.TestCase):
+
+    def setUp(self):
+        self.satisfied = XML_PATH.read_text(encoding="utf-8")
+        self.unsatisfied = self.satisfied.replace("添加朋友", "添加")
+
+    def run_steps(self, hierarchies, maxStep, batch_supported=True):
+        batches, self.steps = [], []
+        server = ThreadingHTTPServer(("127.0.0.1", 0), make_monkey_handler(hierarchies, batches, self.steps))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        fb = FastbotManager.__new__(FastbotManager)
+        fb.session = FastbotSession(ForwardedDevice(server.server_address[1]))
+        fb._blockEncoder = None
+        fb.batch_supported = batch_supported
+        fb.logScript = lambda execution_info: None
+        self.addCleanup(fb.session.close)
+
+        runner = make_runner(
+            cache_size=0, properties=StaticProperties, Driver=RunDriver, maxStep=maxStep,
+            profile_period=0, pipeline=False, batch_steps=3, batch_fingerprints=False,
+        )
+        runner._block_funcs = {"widgets": [], "trees": []}
+        runner._blockCache = OrderedDict()
+        result = RecordingResult()
+        runner._runSteps(fb, result, resultSyncer=None)
+        return batches, result
+
+    def test_batch(self):
+        S, U = self.satisfied, self.unsatisfied
+        batches, result = self.run_steps([U, U, U, S, U, U], maxStep=6)
+        self.assertEqual(batches, [1, 3, 1, 1])
+        self.assertEqual(result.executed, [4])
+
+    def test_rewind(self):
+        S, U = self.satisfied, self.unsatisfied
+        # a property could have been executed on the 3rd event
+        batches, result = self.run_steps([U, U, S, U, U, U], maxStep=4)
+        self.assertEqual(batches, [1, 3, 1])
+        self.assertEqual(result.executed, [])
+        # the steps count sent to fastbot is the count of its events
+        self.assertEqual(self.steps, [1, 2, 5])
+
+    def test_rewind_keeps_events_count(self):
+        S, U = self.satisfied, self.unsatisfied
+        batches, result = self.run_steps([U, U, S, U, S, U], maxStep=4)
+        self.assertEqual(batches, [1, 3, 1])
+        # executed on the 5th event of fastbot, the 4th counted step
+        self.assertEqual(result.executed, [5])
+
+    def test_not_supported(self):
+        S, U = self.satisfied, self.unsatisfied
+        batches, result = self.run_steps([U, U, U, S], maxStep=4, batch_supported=False)
+        self.assertEqual(batches, [1, 1, 1, 1])
+        self.assertEqual(result.executed, [4])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+import gzip
+import tempfile
+import time
+import unittest
+from unittest import mock
+from pathlib import Path
+
+from kea2.logSink import LogFollower, RotatingFileSink, closeOpenSinks, logSegments, readLog
+
+
+class TestRotatingFileSink(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.log_file = Path(self.tmp.name) / "fastbot.log"
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_block_buffered(self):
+        sink = RotatingFileSink(self.log_file, buffer_size=100)
+        sink.write("step 1\n")
+        self.assertEqual(self.log_file.read_text(), "")
+        sink.write("x" * 100 + "\n")
+        self.assertEqual(self.log_file.read_text(), "step 1\n" + "x" * 100 + "\n")
+        sink.write("step 2\n")
+        sink.close()
+        self.assertTrue(self.log_file.read_text().endswith("step 2\n"))
+
+    def test_rotate(self):
+        lines = [f"step {i}\n" for i in range(100)]
+        sink = RotatingFileSink(self.log_file, buffer_size=0, max_bytes=100, backup_count=3, compress="gzip")
+        for line in lines:
+            sink.write(line)
+        sink.close()
+
+        segments = logSegments(self.log_file)
+        self.assertEqual([p.name for p in segments], [
+            "fastbot.log.3.gz", "fastbot.log.2.gz", "fastbot.log.1.gz", "fastbot.log.gz"
+        ])
+        # the oldest files are removed, the rest is read in order
+        content = "".join(readLog(self.log_file))
+        self.assertTrue("".join(lines).endswith(content))
+        self.assertIn("step 99\n", content)
+        self.assertNotIn("step 0\n", content)
+
+    def test_follow_rotated(self):
+        lines = [f"step {i}\n" for i in range(60)]
+        sink = RotatingFileSink(self.log_file, buffer_size=0, max_bytes=100, backup_count=10, compress="gzip")
+        follower = LogFollower(self.log_file)
+        content = []
+        for i, line in enumerate(lines):
+            sink.write(line)
+            if i % 7 == 0:
+                # the compressed stream is readable after flushing, before closing
+                sink.flush()
+                content.extend(follower.read())
+        sink.close()
+        content.extend(follower.read())
+        self.assertEqual("".join(content), "".join(lines))
+
+    def test_flush_when_quiet(self):
+        with mock.patch("kea2.logSink.FLUSH_INTERVAL", 0.05):
+            sink = RotatingFileSink(self.log_file, buffer_size=1024, compress="gzip")
+            sink.write("step 1\n")
+            for _ in range(100):
+                if "".join(readLog(self.log_file)):
+                    break
+                time.sleep(0.02)
+            self.assertEqual("".join(readLog(self.log_file)), "step 1\n")
+            sink.close()
+
+    def test_close_open_sinks(self):
+        sink = RotatingFileSink(self.log_file, buffer_size=1024, compress="gzip")
+        sink.write("[Fastbot] Internal error\n")
+        # e.g., before os._exit
+        closeOpenSinks()
+        self.assertIsNone(sink.f)
+        self.assertEqual("".join(readLog(self.log_file)), "[Fastbot] Internal error\n")
+
+    def test_rotate_without_backups(self):
+        with self.assertRaises(ValueError):
+            RotatingFileSink(self.log_file, max_bytes=100, backup_count=0)
+
+    def test_truncated(self):
+        with gzip.open(f"{self.log_file}.gz", "wb") as f:
+            f.write(b"step 1\n" * 1000)
+        data = Path(f"{self.log_file}.gz").read_bytes()
+        Path(f"{self.log_file}.gz").write_bytes(data[:-10])
+        with self.assertLogs("kea2.logSink", level="WARNING"):
+            content = "".join(readLog(self.log_file))
+        self.assertTrue(content.startswith("step 1\n"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+import io
+import tempfile
+import threading
+import time
+import unittest
+from contextlib import redirect_stdout
+from pathlib import Path
+from unittest import mock
+
+from kea2.adbUtils import ADBStreamShell_V2
+from kea2.logSink import RotatingFileSink, readLog
+from kea2 import logWatcher
+from kea2.logWatcher import MAX_SECTION_LINES, FastbotLogParser, LogWatcher
+
+
+class TestFastbotLogParser(unittest.TestCase):
+
+    def test_exception(self):
+        parser = FastbotLogParser()
+        parser.feed("[Fastbot] step 1\n[Fastbot][2025] Internal error\n")
+        # the body is not complete yet
+        parser.flush()
+        parser.feed("java.lang.NullPointer")
+        parser.feed("Exception\n\tat com.bytedance.fastbot\n")
+        with self.assertRaises(RuntimeError) as cm:
+            parser.flush()
+        self.assertIn("java.lang.NullPointerException\n\tat com.bytedance.fastbot", str(cm.exception))
+
+    def test_exception_ends_at_next_record(self):
+        parser = FastbotLogParser()
+        parser.feed("[Fastbot][2025] Internal error\njava.lang.IllegalStateException: boom\n")
+        parser.feed("\tat com.bytedance.fastbot.A\nCaused by: java.lang.NullPointerException\n\t... 3 more\n")
+        # the log keeps going, no idle time is needed to complete the section
+        with self.assertRaises(RuntimeError) as cm:
+            parser.feed("[Fastbot] step 2\n")
+        self.assertIn("boom\n\tat com.bytedance.fastbot.A\nCaused by", str(cm.exception))
+        self.assertNotIn("step 2", str(cm.exception))
+
+    def test_statistic_once(self):
+        parser = FastbotLogParser()
+        parser.feed("[Fastbot] step 1\n" * 1000)
+        self.assertEqual(parser._section, [])
+        out = io.StringIO()
+        with redirect_stdout(out):
+            parser.feed("// Monkey is over!\nTotal steps: 10\n")
+            parser.flush()
+            parser.feed("Coverage: 10%\n")
+            parser.flush(final=True)
+        self.assertEqual(out.getvalue().count("[INFO] Fastbot exit"), 1)
+        self.assertIn("Total steps: 10", out.getvalue())
+
+    def test_bounded_section(self):
+        parser = FastbotLogParser()
+        with redirect_stdout(io.StringIO()):
+            parser.feed("// Monkey is over!\n" + "line\n" * (MAX_SECTION_LINES * 10))
+        self.assertLessEqual(len(parser._section), MAX_SECTION_LINES)
+        self.assertTrue(parser.statistic_printed)
+
+
+class TestLogWatcher(unittest.TestCase):
+
+    def test_woken_by_writer(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            log_file = Path(tmp) / "fastbot.log"
+            out = io.StringIO()
+            with open(log_file, "w", encoding="utf-8") as f, redirect_stdout(out):
+                # never poll in this test
+                watcher = LogWatcher(log_file, poll_interval=60)
+                f.write("[Fastbot] step 1\n// Monkey is over!\nTotal steps: 1\n")
+                f.flush()
+                watcher.notify()
+                for _ in range(100):
+                    if watcher.statistic_printed:
+                        break
+                    time.sleep(0.05)
+                self.assertTrue(watcher.statistic_printed)
+                watcher.close()
+            self.assertIn("Total steps: 1", out.getvalue())
+
+    def test_backpressure(self):
+        with mock.patch.object(logWatcher, "MAX_PENDING_CHUNKS", 2), redirect_stdout(io.StringIO()):
+            watcher = LogWatcher(poll_interval=60)
+            parsed = []
+            feed = watcher.parser.feed
+            slow = threading.Event()
+
+            def slow_feed(text):
+                slow.wait(timeout=5)
+                parsed.append(text)
+                feed(text)
+            watcher.parser.feed = slow_feed
+            writer = threading.Thread(target=lambda: [watcher.write(f"[Fastbot] step {i}\n") for i in range(10)])
+            writer.start()
+            time.sleep(0.3)
+            # the writer waits for the watcher instead of dropping the log
+            self.assertTrue(writer.is_alive())
+            slow.set()
+            writer.join(timeout=5)
+            watcher.close()
+        self.assertEqual(parsed, [f"[Fastbot] step {i}\n" for i in range(10)])
+
+    def test_shell_sinks(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            log_file = Path(tmp) / "fastbot.log"
+            out = io.StringIO()
+            with redirect_stdout(out):
+                watcher = LogWatcher(poll_interval=60)
+                shell = ADBStreamShell_V2(None)
+                shell.add_sink(RotatingFileSink(log_file, compress="gzip")).add_sink(watcher)
+                shell.stdout = shell.stderr = None
+                shell._generator = iter([
+                    ("stdout", b"[Fastbot] step 1\n"),
+                    ("stderr", b"// Monkey is over!\n"),
+                    ("stdout", b"Total steps: 1\n"),
+                    ("exit", 0),
+                ])
+                # the sinks are closed when the shell exits
+                shell._process_output()
+            self.assertTrue(watcher.statistic_printed)
+            self.assertIn("Total steps: 1", out.getvalue())
+            self.assertEqual("".join(readLog(log_file)), "[Fastbot] step 1\n// Monkey is over!\nTotal steps: 1\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+import io
+import json
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import TestCase, mock
+
+import kea2.keaUtils as keaUtils
+from kea2.keaUtils import JsonResult
+from kea2.resultStore import ResultStore, readResult
+
+
+class Properties(TestCase):
+
+    def test_a(self):
+        pass
+
+    def test_b(self):
+        pass
+
+
+class TestResultStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.res_file = Path(self.tmp.name) / "result_1.json"
+        self.exec_file = Path(self.tmp.name) / "property_exec_info_1.json"
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_journal_replay(self):
+        store = ResultStore(self.res_file, self.exec_file)
+        store.compact({"p": {"precond_satisfied": 1, "executed": 0, "fail": 0, "error": 0}})
+        store.append([("p", {"precond_satisfied": 2, "executed": 1, "fail": 0, "error": 0})])
+        store.append([("p", {"precond_satisfied": 3, "executed": 1, "fail": 1, "error": 0})])
+        store.flush()
+        # killed while writing a record
+        with open(f"{self.res_file}.journal", "a", encoding="utf-8") as fp:
+            fp.write('["p",4,')
+
+        with open(self.res_file, encoding="utf-8") as fp:
+            self.assertEqual(json.load(fp)["p"]["precond_satisfied"], 1)
+        with self.assertLogs("kea2.resultStore", level="WARNING"):
+            res = readResult(self.res_file)
+        self.assertEqual(res["p"], {"precond_satisfied": 3, "executed": 1, "fail": 1, "error": 0})
+        store.close()
+
+    def test_json_result(self):
+        props = {"a": Properties("test_a"), "b": Properties("test_b")}
+        JsonResult.setProperties(props)
+        result = JsonResult(io.StringIO(), True, 0)
+        with mock.patch.object(keaUtils, "RESFILE", self.res_file, create=True), \
+             mock.patch.object(keaUtils, "PROP_EXEC_RESFILE", self.exec_file, create=True):
+            # the first flush writes the snapshot
+            result.flushResult()
+            with open(self.res_file, encoding="utf-8") as fp:
+                self.assertEqual(set(json.load(fp)), {f"{__name__}.Properties.test_a", f"{__name__}.Properties.test_b"})
+
+            for _ in range(3):
+                result.addPrecondSatisfied(props["a"])
+                result.addExcuted(props["a"], 1)
+                result.updateExectedInfo()
+                result.flushResult()
+            journal = Path(f"{self.res_file}.journal").read_text(encoding="utf-8").splitlines()
+            # only the changed property is appended
+            self.assertEqual(journal[-1], f'["{__name__}.Properties.test_a",3,3,0,0]')
+            self.assertEqual(len(journal), 3)
+            self.assertEqual(len(self.exec_file.read_text(encoding="utf-8").splitlines()), 3)
+
+            result.closeResult()
+        self.assertFalse(Path(f"{self.res_file}.journal").exists())
+        with open(self.res_file, encoding="utf-8") as fp:
+            self.assertEqual(json.load(fp)[f"{__name__}.Properties.test_a"]["executed"], 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
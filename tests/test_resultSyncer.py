@@ -0,0 +1,131 @@
+import shutil
+import subprocess
+import tempfile
+import unittest
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
+
+from kea2 import resultSyncer
+from kea2.resultSyncer import ResultSyncer
+
+
+class LocalDevice:
+    """
+    Fake device running the shell commands on the host.
+    """
+    def __init__(self):
+        self.exec_out_cmds = []
+        self.pulled = []
+        self.sync = SimpleNamespace(pull=self._pull)
+
+    def shell(self, cmd):
+        return subprocess.run(cmd, shell=True, capture_output=True, text=True).stdout
+
+    def exec_out(self, cmd, stream=False):
+        self.exec_out_cmds.append(cmd)
+        if stream:
+            proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            return SimpleNamespace(conn=SimpleNamespace(makefile=lambda mode: proc.stdout), close=proc.wait)
+        return subprocess.run(cmd, shell=True, capture_output=True).stdout
+
+    def _pull(self, remote, local):
+        self.pulled.append(remote)
+        shutil.copyfile(remote, local)
+
+
+class TestIncrementalSync(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.device_dir = Path(tmp.name) / "device" / "output_stamp"
+        (self.device_dir / "screenshots").mkdir(parents=True)
+        self.output_dir = Path(tmp.name) / "host"
+
+        self.syncer = ResultSyncer.__new__(ResultSyncer)
+        self.syncer.device_output_dir = str(self.device_dir)
+        self.syncer.output_dir = self.output_dir / self.device_dir.name
+        self.syncer._offsets = dict()
+        self.syncer._pulled = dict()
+        self.syncer._pulled_screenshots = set()
+        self.syncer.tar_sync = False
+        self.syncer.dev = LocalDevice()
+
+    def local(self, name):
+        return (self.output_dir / self.device_dir.name / name).read_bytes()
+
+    def test_sync(self):
+        steps = self.device_dir / "steps.log"
+        steps.write_bytes(b"step 1\n")
+        (self.device_dir / "screenshots" / "1.png").write_bytes(b"png1")
+        self.syncer._sync_device_data()
+        self.assertEqual(self.local("steps.log"), b"step 1\n")
+        self.assertEqual(self.local("screenshots/1.png"), b"png1")
+        self.assertFalse((self.device_dir / "screenshots" / "1.png").exists())
+
+        with open(steps, "ab") as f:
+            f.write("step 2 中文\n".encode("utf-8"))
+        (self.device_dir / "screenshots" / "2.png").write_bytes(b"png2")
+        self.syncer._sync_device_data()
+        self.assertEqual(self.local("steps.log"), steps.read_bytes())
+        # only the appended bytes are pulled
+        self.assertIn("tail -c +8 ", self.syncer.dev.exec_out_cmds[-1])
+        self.assertEqual(self.syncer.dev.pulled.count(str(self.device_dir / "screenshots" / "1.png")), 1)
+        self.assertEqual(self.local("screenshots/2.png"), b"png2")
+
+        # nothing changed
+        pulled = len(self.syncer.dev.pulled)
+        self.syncer._sync_device_data()
+        self.assertEqual(len(self.syncer.dev.pulled), pulled)
+        self.assertEqual(len(self.syncer.dev.exec_out_cmds), 2)
+
+    def test_tar_sync(self):
+        self.syncer.tar_sync = True
+        for i in range(3):
+            (self.device_dir / "screenshots" / f"screen {i}.png").write_bytes(f"png{i}".encode())
+        self.syncer._sync_device_data()
+        for i in range(3):
+            self.assertEqual(self.local(f"screenshots/screen {i}.png"), f"png{i}".encode())
+        self.assertEqual(list((self.device_dir / "screenshots").iterdir()), [])
+        # streamed in one command, not pulled one by one
+        self.assertEqual(self.syncer.dev.pulled, [])
+        self.assertTrue(self.syncer.tar_sync)
+
+    def test_tar_chunks(self):
+        self.syncer.tar_sync = True
+        for i in range(5):
+            (self.device_dir / "screenshots" / f"{i}.png").write_bytes(f"png{i}".encode())
+        with mock.patch.object(resultSyncer, "SYNC_CHUNK", 2):
+            self.syncer._sync_device_data()
+        tar_cmds = [cmd for cmd in self.syncer.dev.exec_out_cmds if "tar -cf" in cmd]
+        self.assertEqual(len(tar_cmds), 3)
+        # removed in the same command, once archived
+        self.assertTrue(all("&& rm -f " in cmd for cmd in tar_cmds))
+        self.assertEqual(list((self.device_dir / "screenshots").iterdir()), [])
+        self.assertEqual(len(self.syncer._pulled_screenshots), 5)
+
+    def test_tar_failed_keeps_files(self):
+        shot = self.device_dir / "screenshots" / "1.png"
+        shot.write_bytes(b"png1")
+        # the second file disappeared before archived, tar fails
+        self.syncer._pull_tar([str(shot), str(self.device_dir / "screenshots" / "2.png")])
+        self.assertEqual(self.local("screenshots/1.png"), b"png1")
+        self.assertEqual(self.syncer._pulled_screenshots, {str(shot)})
+        # not removed, as the archive is not complete
+        self.assertTrue(shot.exists())
+
+    def test_tar_fallback(self):
+        self.syncer.tar_sync = True
+        (self.device_dir / "screenshots" / "1.png").write_bytes(b"png1")
+        exec_out = self.syncer.dev.exec_out
+        self.syncer.dev.exec_out = lambda cmd, stream=False: exec_out(
+            cmd.replace("tar -cf", "no-such-tar -cf"), stream
+        )
+        self.syncer._sync_device_data()
+        self.assertFalse(self.syncer.tar_sync)
+        self.assertEqual(self.local("screenshots/1.png"), b"png1")
+
+
+if __name__ == "__main__":
+    unittest.main()
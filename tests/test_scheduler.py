@@ -0,0 +1,57 @@
+import io
+import random
+import unittest
+from types import SimpleNamespace
+
+from kea2.keaUtils import JsonResult, precondition, prob
+from kea2.scheduler import LeastExecutedScheduler, NoveltyScheduler, makeScheduler
+from test_keaUtils import make_runner
+
+
+class ProbProperties(unittest.TestCase):
+
+    @prob(0.2)
+    @precondition(lambda self: True)
+    def test_rare(self):
+        ...
+
+    @precondition(lambda self: True)
+    def test_always(self):
+        ...
+
+
+def executed(state, tb=""):
+    return SimpleNamespace(state=state, tb=tb)
+
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.runner = make_runner(cache_size=0, properties=ProbProperties)
+        self.props = self.runner.allProperties
+        self.result = JsonResult(io.StringIO(), True, 0)
+
+    def test_prob_honored(self):
+        random.seed(0)
+        selected = [self.runner._selectProperty(self.props, self.result) for _ in range(1000)]
+        # a candidate in 20% of the steps, then chosen in half of them
+        self.assertLess(selected.count("test_rare"), 150)
+
+    def test_least_executed(self):
+        self.result.getStatistic(self.props["test_rare"]).executed = 3
+        scheduler = LeastExecutedScheduler(random.Random(0))
+        for _ in range(10):
+            self.assertEqual(scheduler.choose(list(self.props), self.props, self.result), "test_always")
+
+    def test_novelty_prefers_new_failures(self):
+        scheduler = NoveltyScheduler(random.Random(0))
+        scheduler.onExecuted("test_rare", executed("fail", "Traceback\nAssertionError: a"))
+        scheduler.onExecuted("test_rare", executed("fail", "Traceback\nAssertionError: a"))
+        scheduler.onExecuted("test_always", executed("pass"))
+        self.assertEqual(scheduler.weight("test_rare", self.props, self.result), 5)
+        scheduler.onExecuted("test_rare", executed("fail", "Traceback\nAssertionError: b"))
+        self.assertEqual(scheduler.weight("test_rare", self.props, self.result), 9)
+
+    def test_unknown_scheduler(self):
+        with self.assertRaises(ValueError):
+            makeScheduler("greedy")
@@ -0,0 +1,56 @@
+import json
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+
+from kea2 import tracer
+from kea2.tracer import span, startTracing, stopTracing
+
+
+class TestTracer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.trace_file = Path(self.tmp.name) / "trace.json"
+
+    def tearDown(self):
+        stopTracing()
+        self.tmp.cleanup()
+
+    def test_disabled_is_noop(self):
+        self.assertIs(span("step"), span("other", step=1))
+        with span("step"):
+            pass
+        self.assertFalse(self.trace_file.exists())
+
+    def test_nested_spans(self):
+        startTracing(self.trace_file)
+        with span("step", step=1):
+            with span("preconditions"):
+                pass
+        t = threading.Thread(target=lambda: span("/stepMonkey", "fastbot").__enter__().__exit__(), name="prefetch")
+        t.start()
+        t.join()
+        stopTracing()
+
+        events = json.loads(self.trace_file.read_text(encoding="utf-8"))
+        spans = {e["name"]: e for e in events if e["ph"] == "X"}
+        self.assertEqual(set(spans), {"step", "preconditions", "/stepMonkey"})
+        step, precond = spans["step"], spans["preconditions"]
+        self.assertEqual(step["args"], {"step": 1})
+        self.assertLessEqual(step["ts"], precond["ts"])
+        self.assertGreaterEqual(step["ts"] + step["dur"], precond["ts"] + precond["dur"])
+        self.assertNotEqual(spans["/stepMonkey"]["tid"], step["tid"])
+        threads = {e["args"]["name"] for e in events if e["name"] == "thread_name"}
+        self.assertIn("prefetch", threads)
+
+    def test_unclosed_trace_is_readable(self):
+        startTracing(self.trace_file)
+        for i in range(tracer.FLUSH_EVENTS):
+            with span("step", step=i):
+                pass
+        # the events are written while running, the closing bracket is missing
+        content = self.trace_file.read_text(encoding="utf-8")
+        events = json.loads(content.rstrip().rstrip(",") + "]")
+        self.assertGreater(sum(e["ph"] == "X" for e in events), 0)
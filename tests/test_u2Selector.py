@@ -1,5 +1,5 @@
 import unittest
-from kea2.u2Driver import U2StaticChecker, U2StaticDevice
+from kea2.u2Driver import U2StaticChecker, U2StaticDevice, _XPathCache, _HindenWidgetFilter, np
 from lxml import etree
 from pathlib import Path
 
@@ -195,6 +195,207 @@ class TestEdgeCases(unittest.TestCase):
         assert not self.d(text="不存在的文本").exists
         assert not self.d(resourceId="com.example.nonexistent").exists
 
+class TestSelectorMatcher(unittest.TestCase):
+
+    SELECTORS = [
+        dict(text="添加朋友"),
+        dict(text="添加朋友", className="android.widget.TextView"),
+        dict(text="添加朋友", clickable=False),
+        dict(text="微信(690)"),
+        dict(text=""),
+        dict(resourceId=""),
+        dict(resourceId="com.tencent.mm:id/search_ll", className="android.widget.LinearLayout"),
+        dict(className="android.widget.Button"),
+        dict(className="android.widget.TextView", textContains="朋友"),
+        dict(className="android.widget.TextView", textStartsWith="添加"),
+        dict(className="android.widget.TextView", descriptionContains=""),
+        dict(packageName="com.tencent.mm", enabled=True),
+        dict(className="android.widget.TextView", instance=2),
+        dict(resourceId="com.example.nonexistent"),
+        dict(enabled=True),
+        dict(textContains="朋友"),
+    ]
+
+    def setUp(self):
+        self.d = get_static_checker()
+
+    def _xpath_match(self, ui):
+        return ui.session.xml.xpath(ui.selector_to_xpath(ui.selector))
+
+    def _selectors(self, d):
+        for kwargs in self.SELECTORS:
+            yield kwargs, d(**kwargs)
+        yield "child", d(resourceId="android:id/list").child(text="通讯录")
+        yield "child", d(className="android.widget.LinearLayout").child(className="android.widget.TextView")
+        yield "sibling", d(className="android.widget.TextView").sibling(className="android.widget.ImageView")
+        yield "sibling and child", d(text="添加朋友").sibling(clickable=False).child(textContains="")
+        ui = d(className="android.widget.LinearLayout", instance=1).child(className="android.widget.TextView")
+        yield "instance", ui
+
+    def test_matcher_matches_xpath(self):
+        for kwargs, ui in self._selectors(self.d):
+            matched = self.d.matcher.match(ui.selector)
+            self.assertIsNotNone(matched, kwargs)
+            self.assertEqual(matched, self._xpath_match(ui), kwargs)
+
+    def test_matcher_respects_covered(self):
+        for kwargs, ui in self._selectors(self.d):
+            # exists adds covered=False to the selector
+            exists = ui.exists
+            self.assertEqual(exists, bool(self._xpath_match(ui)), kwargs)
+
+    def test_one_walk_per_hierarchy(self):
+        for _, ui in self._selectors(self.d):
+            self.d.matcher.match(ui.selector)
+        # the selectors are known now, they are matched in a single walk of the next hierarchy
+        self.d.xml = etree.parse(XML_PATH).getroot()
+        for kwargs, ui in self._selectors(self.d):
+            self.assertEqual(self.d.matcher.match(ui.selector), self._xpath_match(ui), kwargs)
+        self.assertEqual(self.d.matcher.walks, 1)
+
+    def test_fallback_to_xpath(self):
+        self.assertIsNone(self.d.matcher.match(self.d(text="it's").selector))
+        self.assertIsNone(self.d.matcher.match(self.d(textMatches="添加.*").selector))
+
+
+class TestXPathCache(unittest.TestCase):
+
+    def setUp(self):
+        self.d = get_static_checker()
+
+    def test_cache_hit_across_hierarchies(self):
+        cache = _XPathCache(maxsize=8)
+        ui = self.d(resourceId="android:id/list").child(text="通讯录")
+        xpath = cache.get(ui.selector, ui.selector_to_xpath)
+        self.assertEqual(xpath(self.d.xml), self.d.xml.xpath(ui.selector_to_xpath(ui.selector)))
+
+        d = get_static_checker()
+        same = d(resourceId="android:id/list").child(text="通讯录")
+        self.assertIs(cache.get(same.selector, same.selector_to_xpath), xpath)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_key_distinguishes_value_types(self):
+        self.assertNotEqual(
+            _XPathCache.selector_key(self.d(text=1).selector),
+            _XPathCache.selector_key(self.d(text=True).selector),
+        )
+
+    def test_lru_eviction(self):
+        cache = _XPathCache(maxsize=2)
+        for text in ("a", "b", "a", "c"):
+            ui = self.d(text=text)
+            cache.get(ui.selector, ui.selector_to_xpath)
+        self.assertEqual(len(cache), 2)
+        ui = self.d(text="a")
+        cache.get(ui.selector, ui.selector_to_xpath)
+        self.assertEqual((cache.hits, cache.misses), (2, 3))
+
+
+class TestStaticXpath(unittest.TestCase):
+
+    def test_page_source_shared_in_one_hierarchy(self):
+        d = get_static_checker()
+        assert d.xpath('//*[@text="添加朋友"]').exists
+        assert not d.xpath('//*[@text="不存在的文本"]').exists
+        self.assertIs(d.xpath.get_page_source(), d.xpath.get_page_source())
+
+    def test_page_source_renewed_with_hierarchy(self):
+        d = get_static_checker()
+        source = d.xpath.get_page_source()
+        d = get_static_checker()
+        self.assertIsNot(d.xpath.get_page_source(), source)
+
+
+@unittest.skipIf(np is None, "numpy not installed")
+class TestCoveredBackend(unittest.TestCase):
+
+    def _covered(self, backend):
+        root = etree.parse(XML_PATH).getroot()
+        _HindenWidgetFilter(root, backend=backend)
+        return [node.get("covered") for node in root.iter("node")]
+
+    def test_numpy_same_as_rtree(self):
+        rtree_covered = self._covered("rtree")
+        self.assertIn("true", rtree_covered)
+        self.assertEqual(self._covered("numpy"), rtree_covered)
+
+    def test_drawing_order(self):
+        xml = (
+            '<hierarchy>'
+            '<node bounds="[0,0][100,100]" clickable="true" drawing-order="2" />'
+            '<node bounds="[40,40][60,60]" clickable="false" drawing-order="1" />'
+            '<node bounds="[0,0][10,10]" clickable="false" drawing-order="3" />'
+            '</hierarchy>'
+        )
+        for backend in ("rtree", "numpy"):
+            root = etree.fromstring(xml)
+            _HindenWidgetFilter(root, backend=backend)
+            self.assertEqual([n.get("covered") for n in root], ["false", "true", "false"], backend)
+
+
+class TestLazyCovered(unittest.TestCase):
+
+    def test_lazy_same_as_full_pass(self):
+        root = etree.parse(XML_PATH).getroot()
+        _HindenWidgetFilter(root)
+        expected = [node.get("covered") for node in root.iter("node")]
+
+        root = etree.parse(XML_PATH).getroot()
+        covered_filter = _HindenWidgetFilter(root, lazy=True)
+        self.assertEqual([covered_filter.is_covered(node) for node in root.iter("node")], expected)
+        self.assertFalse(covered_filter.full_pass_done)
+
+    def test_full_pass_avoided(self):
+        d = get_static_checker()
+        assert not d(text="不存在的文本").exists
+        assert not d(text="微信(690)").exists
+        self.assertFalse(d.covered_filter.full_pass_done)
+
+    def test_relations_without_full_pass(self):
+        d = get_static_checker()
+        assert d(resourceId="android:id/list").child(description="手机联系人，，添加通讯录中的朋友").exists
+        self.assertFalse(d.covered_filter.full_pass_done)
+
+    def test_xpath_forces_full_pass(self):
+        d = get_static_checker()
+        assert d.xpath('//*[@text="添加朋友"]').exists
+        self.assertTrue(d.covered_filter.full_pass_done)
+
+
+class TestIncrementalHierarchy(unittest.TestCase):
+
+    def setUp(self):
+        self.raw = XML_PATH.read_text(encoding="utf-8")
+        self.checker = U2StaticCheckerForTest()
+
+    def test_identical_hierarchy_reused(self):
+        d = self.checker.getInstance(self.raw)
+        root, count = d.xml, self.checker.identical_hierarchy_count
+        assert d(text="添加朋友").exists
+        d = self.checker.getInstance(self.raw)
+        self.assertIs(d.xml, root)
+        self.assertEqual(self.checker.identical_hierarchy_count, count + 1)
+        assert d(text="添加朋友").exists
+
+    def test_covered_reused_for_unchanged_geometry(self):
+        d = self.checker.getInstance(self.raw)
+        for node in d.xml.iter("node"):
+            d.covered_filter.is_covered(node)
+
+        changed = self.raw.replace('text="添加朋友"', 'text="添加好友"')
+        d = self.checker.getInstance(changed)
+        assert not d(text="微信(690)").exists
+        assert d(text="添加好友").exists
+        self.assertEqual(d.covered_filter.reused_count, len(list(d.xml.iter("node"))))
+
+        expected = etree.fromstring(changed.encode("utf-8"))
+        _HindenWidgetFilter(expected)
+        self.assertEqual(
+            [d.covered_filter.is_covered(node) for node in d.xml.iter("node")],
+            [node.get("covered") for node in expected.iter("node")],
+        )
+
+
 class TestWidget(unittest.TestCase):
 
     def test_widget(self):